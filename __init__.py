@@ -12,6 +12,7 @@ from legopython import (
     lp_interface,
     lp_postgresql,
     lp_s3,
+    lp_s3async,
     lp_secretsmanager,
     lp_settings
 )
@@ -27,6 +28,7 @@ __all__ = [
     "lp_interface",
     "lp_postgresql",
     "lp_s3",
+    "lp_s3async",
     "lp_secretsmanager",
     "lp_settings",
     "__description__",
@@ -10,6 +10,7 @@ from legopython import (
     lp_interface,
     lp_postgresql,
     lp_s3,
+    lp_s3async,
     lp_secretsmanager,
     lp_settings
 )
@@ -24,6 +25,7 @@ __all__ = [
     "lp_interface",
     "lp_postgresql",
     "lp_s3",
+    "lp_s3async",
     "lp_secretsmanager",
     "lp_settings"
 ]
@@ -8,12 +8,70 @@ from enum import Enum
 from functools import wraps
 from getpass import getpass
 from pathlib import Path
-from time import time
+from time import time, sleep
+from email.utils import parsedate_to_datetime
+from typing import Generator, NamedTuple
+from urllib.parse import urlsplit
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque, OrderedDict
 import json
 import base64
+import hashlib
+import random
+import sqlite3
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from legopython.lp_logging import logger
 
+#Connections kept open per host by the shared sessions, size HTTP_POOL_MAXSIZE to the number of threads calling one API
+HTTP_POOL_MAXSIZE = 32
+#Responses written to the on-disk response cache between purges of its expired and excess rows
+HTTP_CACHE_PRUNE_INTERVAL = 100
+
+__http_sessions = {}
+__http_sessions_lock = threading.Lock()
+
+
+def get_http_session(url:str, pool_maxsize:int = None, keep_alive:bool = True) -> requests.Session:
+    '''Return the shared requests.Session for url's scheme and host, creating it on first use.
+
+    Reusing one session per host keeps connections alive between calls, so only the first request to a host pays for
+    the TCP and TLS handshakes. The session's connection pool is thread-safe and holds up to pool_maxsize connections.
+    The session never stores cookies, so a cookie set for one caller's credentials is not sent with another's.
+    url = Address (or base address) of the API
+    pool_maxsize = Connections kept open to the host, threads beyond this wait for a free connection (default: HTTP_POOL_MAXSIZE)
+    keep_alive = False sends Connection: close so every request uses a new connection
+    '''
+    if pool_maxsize is None:
+        pool_maxsize = HTTP_POOL_MAXSIZE
+    parts = urlsplit(url)
+    registrykey = (parts.scheme, parts.netloc, pool_maxsize, keep_alive)
+    session = __http_sessions.get(registrykey)
+    if session is None:
+        with __http_sessions_lock:
+            session = __http_sessions.get(registrykey)
+            if session is None:
+                session = requests.Session()
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[])) #shared between users and envs, keep no cookies
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                if not keep_alive:
+                    session.headers['Connection'] = 'close'
+                __http_sessions[registrykey] = session
+                logger.debug(f'Created http session for {parts.scheme}://{parts.netloc}')
+    return session
+
+
+def close_http_sessions():
+    '''Close every shared session and its open connections'''
+    with __http_sessions_lock:
+        for session in __http_sessions.values():
+            session.close()
+        __http_sessions.clear()
+
 
 def print_raw_request(requesttype:str, url: str, **kwargs):
     """Prints raw http requests to console for troubleshooting purposes.
@@ -32,40 +90,359 @@ def print_raw_request(requesttype:str, url: str, **kwargs):
     ))
 
 
-def send_http_call(method:str, url:str, print_request:bool = False, timeout:int = 1000, http_attempts:int = 1, **kwargs) -> requests:
-    '''Sends an api call via requests.request(method, url, args) and handles errors and retries
+class HttpResponseCache:
+    """Cache of GET responses for send_http_call, turned on with enable_response_cache.
+
+    Entries live in an in-memory LRU and, if disk_path is set, in a SQLite file that survives restarts. A response is
+    served from the cache until its TTL runs out; after that the next call revalidates it with If-None-Match /
+    If-Modified-Since, so an unchanged resource costs a 304 with no body. Entries are keyed by the url and query, the
+    Accept header and the AuthHandler name and environment whose credentials are in the Authorization header, so
+    responses for different environments are never shared and token refreshes keep their entries. Calls with
+    credentials that didn't come from an AuthHandler are keyed by a digest of the Authorization header instead.
+    The disk tier drops expired rows and the oldest beyond max_disk_entries every HTTP_CACHE_PRUNE_INTERVAL writes.
+    ttl = Default seconds a response is fresh
+    ttls = Dict of url prefix: seconds overriding ttl for matching endpoints, the longest matching prefix wins
+    max_entries = Entries held in memory before the least recently used are dropped
+    disk_path = Path of a SQLite file for the on-disk tier (default: memory only)
+    max_disk_entries = Entries kept in the disk tier
+    """
+    namespaces = {} #Authorization header: AuthHandler name-env, shared by every cache
+    _namespaces_lock = threading.Lock()
+
+    def __init__(self, ttl:float = 300, ttls:dict = None, max_entries:int = 1000, disk_path = None, max_disk_entries:int = 10000):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_writes = 0
+        if disk_path:
+            self._disk = sqlite3.connect(str(disk_path), check_same_thread=False)
+            with self._lock, self._disk:
+                self._disk.execute('PRAGMA journal_mode=WAL')
+                self._disk.execute('''CREATE TABLE IF NOT EXISTS http_cache (
+                    key TEXT PRIMARY KEY,
+                    entry TEXT NOT NULL,
+                    content BLOB,
+                    expires REAL NOT NULL,
+                    stored REAL NOT NULL
+                )''')
+            self.prune()
+
+    def ttl_for(self, url:str) -> float:
+        """Seconds a response from url stays fresh"""
+        prefixes = [prefix for prefix in self.ttls if url.startswith(prefix)]
+        return self.ttls[max(prefixes, key=len)] if prefixes else self.ttl
+
+    @classmethod
+    def register_credentials(cls, auth_header:str, namespace:str, previous:str = None):
+        """Key responses for calls made with auth_header under namespace, forgetting the previous header it replaces"""
+        with cls._namespaces_lock:
+            if previous is not None and previous != auth_header:
+                cls.namespaces.pop(previous, None)
+            if auth_header is not None:
+                cls.namespaces[auth_header] = namespace
+
+    @classmethod
+    def key(cls, url:str, params = None, headers:dict = None, namespace:str = None) -> str:
+        """Cache key of a GET of url with params, as seen by namespace or else the credentials in headers"""
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        prepared = requests.Request('GET', url, params=params).prepare().url
+        auth = headers.get('authorization')
+        if namespace is None and auth is not None:
+            namespace = cls.namespaces.get(auth) or hashlib.sha256(str(auth).encode()).hexdigest()
+        return json.dumps([namespace, prepared, headers.get('accept')])
+
+    def get(self, key:str) -> dict:
+        """Return the entry stored under key, from memory or disk, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            if self._disk is None:
+                return None
+            row = self._disk.execute('SELECT entry, content FROM http_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(row[0])
+        entry['content'] = row[1]
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key:str, entry:dict):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key:str, entry:dict):
+        """Store entry under key in memory and on disk"""
+        self._remember(key, entry)
+        if self._disk is None:
+            return
+        with self._lock, self._disk:
+            self._disk.execute('INSERT OR REPLACE INTO http_cache (key, entry, content, expires, stored) VALUES (?, ?, ?, ?, ?)',
+                               (key, json.dumps({name: value for name, value in entry.items() if name != 'content'}), entry['content'], entry['expires'], time()))
+            self._disk_writes += 1
+            prune = self._disk_writes % HTTP_CACHE_PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """Drop expired rows from the disk tier, then the least recently stored beyond max_disk_entries"""
+        if self._disk is None:
+            return
+        with self._lock, self._disk:
+            self._disk.execute('DELETE FROM http_cache WHERE expires <= ?', (time(),))
+            self._disk.execute('DELETE FROM http_cache WHERE key NOT IN (SELECT key FROM http_cache ORDER BY stored DESC LIMIT ?)', (self.max_disk_entries,))
+
+    @staticmethod
+    def validators(entry:dict) -> dict:
+        """Conditional request headers to revalidate a stale entry"""
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    @staticmethod
+    def response(entry:dict) -> requests.Response:
+        """Rebuild a requests.Response from a cache entry, marked with from_cache = True"""
+        response = requests.Response()
+        response.status_code = entry['status_code']
+        response.reason = entry['reason']
+        response.url = entry['url']
+        response.encoding = entry['encoding']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response._content = entry['content'] #pylint: disable=protected-access
+        response.from_cache = True
+        return response
+
+    def store(self, key:str, url:str, response:requests.Response, entry:dict = None) -> requests.Response:
+        """Cache a fresh 200 response, or renew entry on a 304, returning the response to give the caller"""
+        expires = time() + self.ttl_for(url)
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry = {**entry, 'expires': expires}
+            entry['headers'] = {**entry['headers'], **{name: value for name, value in response.headers.items() if name in ('ETag', 'Last-Modified', 'Date')}}
+            self.put(key, entry)
+            return self.response(entry)
+        self.misses += 1
+        if response.status_code == 200 and 'no-store' not in response.headers.get('Cache-Control', ''):
+            self.put(key, {'status_code': response.status_code, 'reason': response.reason, 'url': response.url, 'encoding': response.encoding,
+                           'headers': dict(response.headers), 'content': response.content, 'expires': expires})
+        response.from_cache = False
+        return response
+
+    def clear(self):
+        """Drop every entry, in memory and on disk"""
+        with self._lock:
+            self._entries.clear()
+            if self._disk is not None:
+                with self._disk:
+                    self._disk.execute('DELETE FROM http_cache')
+
+
+__response_cache = None
+
+
+def enable_response_cache(ttl:float = 300, ttls:dict = None, max_entries:int = 1000, disk_path = None, max_disk_entries:int = 10000) -> HttpResponseCache:
+    '''Turn on caching of send_http_call GET responses, see HttpResponseCache for the arguments. Returns the cache.'''
+    global __response_cache
+    __response_cache = HttpResponseCache(ttl, ttls, max_entries, disk_path, max_disk_entries)
+    return __response_cache
+
+
+def disable_response_cache():
+    '''Turn off the send_http_call response cache'''
+    global __response_cache
+    __response_cache = None
+
+
+class RetryPolicy:
+    """How send_http_call retries a failed call.
+
+    Only failures worth retrying are retried: connection errors, timeouts and the statuses in retry_statuses (throttling
+    and server errors). Other 4xx responses fail straight away. Waits grow exponentially with full jitter so clients
+    retrying together spread out, and a Retry-After header on the response (seconds or an HTTP date) is honoured.
+    attempts = Total number of attempts, 1 disables retries
+    backoff = Seconds the first retry waits at most, doubled for each retry after it
+    max_backoff = Upper limit in seconds on the backoff between attempts
+    retry_statuses = HTTP status codes that are retried
+    max_retry_after = Upper limit in seconds on a server's Retry-After
+    """
+    def __init__(self, attempts:int = 3, backoff:float = 0.5, max_backoff:float = 30, retry_statuses:tuple = (408, 425, 429, 500, 502, 503, 504), max_retry_after:float = 120):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = set(retry_statuses)
+        self.max_retry_after = max_retry_after
+
+    def is_retryable(self, error:Exception) -> bool:
+        """True if the call that raised error could succeed if tried again"""
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code in self.retry_statuses
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    def retry_after(self, response:requests.Response) -> float:
+        """Seconds the server asked us to wait in its Retry-After header, None if it didn't"""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0), self.max_retry_after)
+
+    def delay(self, attempt:int, response:requests.Response = None) -> float:
+        """Seconds to wait before retrying after attempt number attempt (starting at 1) failed"""
+        jittered = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        return max(jittered, self.retry_after(response) or 0)
+
+
+def send_http_call(method:str, url:str, print_request:bool = False, timeout:int = 30000, http_attempts:int = 1, session:requests.Session = None, retry_policy:RetryPolicy = None, use_cache:bool = True, cache_namespace:str = None, **kwargs) -> requests:
+    '''Sends an api call via requests.Session.request(method, url, args) and handles errors and retries
 
     method = HTTP Method, enter one of: delete, get, post, patch, head, put, 
     url = String Address to send the api request
-    Timeout = Time in ms to wait for a response. ex) 500 = 0.5 seconds
-    http_attempts = Whole int number of times to attempt to retry and get a response if the request times out.
+    Timeout = Time in ms to wait for a response. ex) 500 = 0.5 seconds, None or a (connect, read) tuple is passed to requests unchanged
+    http_attempts = Whole int number of times to attempt the call, retried on connection errors, timeouts and throttling/server errors (see RetryPolicy)
+    session = requests.Session to send the call with (default: the shared keep-alive session for the url's host, see get_http_session)
+    retry_policy = RetryPolicy controlling which failures are retried and the backoff between attempts (default: RetryPolicy(attempts=http_attempts))
+    use_cache = False to bypass the GET response cache turned on by enable_response_cache
+    cache_namespace = Cache responses under this name instead of the AuthHandler (or digest) of the Authorization header
     **Kwargs accepts values for the following dictionary keys: data, params, headers, cookies, files, auth, allow_redirects, proxies, hooks, stream, verify, cert, json 
 
+    Returns the response. Raises requests.exceptions.HTTPError for an error status, or the last requests exception, once
+    the call fails in a way that isn't retried or runs out of attempts.
+
     Request Module Exceptions: https://github.com/kennethreitz/requests/blob/master/requests/exceptions.py
     '''
     #Print the raw request sent for troubleshooting purposes.
     if print_request:
         print_raw_request(method, url, **kwargs)
     
+    if session is None:
+        session = get_http_session(url)
+    if retry_policy is None:
+        retry_policy = RetryPolicy(attempts=http_attempts)
+
+    cache = __response_cache if use_cache and method.lower() == 'get' and not kwargs.get('stream') else None
+    if cache is not None:
+        cachekey = cache.key(url, kwargs.get('params'), kwargs.get('headers'), cache_namespace)
+        entry = cache.get(cachekey)
+        if entry is not None and entry['expires'] > time():
+            cache.hits += 1
+            logger.debug(f'API GET {url} served from cache')
+            return cache.response(entry)
+        if entry is not None: #stale, ask the server whether it changed
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), **cache.validators(entry)}
+
+    if isinstance(timeout, (int, float)):
+        timeout = timeout / 1000 #requests takes seconds
+
     #Make an API call as specified, retrying failures and raising exceptions for invalid statuses as specified.
-    for retry in range(http_attempts):
+    for attempt in range(1, retry_policy.attempts + 1):
+        response = None
         try:
-            response = requests.request(method = method, url = url, timeout = timeout, **kwargs)
+            response = session.request(method = method, url = url, timeout = timeout, **kwargs)
             response.raise_for_status()
-        except requests.exceptions.ConnectTimeout:
-            logger.info(f'API Attempt #{retry} Timed out while trying to connect to server.')
-            continue
-        except requests.exceptions.ReadTimeout:
-            logger.info(f'API Attempt #{retry}. Server did not send data in alotted time.')
-            continue
-        except requests.exceptions.HTTPError:
-            logger.debug(f'API Attempt #{retry} returned http code {response.status_code}.')
-            continue
-        except requests.exceptions.RequestException as general_error: #General catch for other errors.
-            raise requests.exceptions.RequestException("Response from {} errored, returned status code {}: {} \n{}".format(response.url, response.status_code, response.reason, response.content)) from general_error
+        except requests.exceptions.RequestException as error:
+            if not retry_policy.is_retryable(error) or attempt == retry_policy.attempts:
+                status = f'http code {response.status_code}: {response.reason}' if response is not None else error.__class__.__name__
+                logger.error(f'API {method.upper()} {url} failed with {status} after {attempt} attempt(s)')
+                raise
+            delay = retry_policy.delay(attempt, response)
+            if isinstance(error, requests.exceptions.ConnectTimeout):
+                logger.info(f'API Attempt #{attempt} Timed out while trying to connect to server, retrying in {delay:.2f}s.')
+            elif isinstance(error, requests.exceptions.ReadTimeout):
+                logger.info(f'API Attempt #{attempt}. Server did not send data in alotted time, retrying in {delay:.2f}s.')
+            else:
+                logger.info(f'API Attempt #{attempt} failed with {response.status_code if response is not None else error}, retrying in {delay:.2f}s.')
+            sleep(delay)
         else:
+            if cache is not None:
+                return cache.store(cachekey, url, response, entry)
             return response
-    
+
+
+class HttpCallResult(NamedTuple):
+    """Outcome of one call made by send_http_calls"""
+    index: int #position of the call in the input
+    call: dict #the send_http_call arguments
+    response: requests.Response #None if the call failed
+    error: Exception #None if the call succeeded
+
+
+def __send_batched_call(index:int, call:dict) -> HttpCallResult:
+    """Make one send_http_calls call, capturing its error instead of raising it"""
+    try:
+        response = send_http_call(**call)
+    except Exception as error:
+        logger.debug(f"send_http_calls - call #{index} to {call.get('url')} failed: {error}")
+        return HttpCallResult(index, call, None, error)
+    return HttpCallResult(index, call, response, None)
+
+
+def send_http_calls(calls, max_workers:int = 16, ordered:bool = False, max_pending:int = None) -> Generator[HttpCallResult, None, None]:
+    '''Sends many api calls through send_http_call concurrently, yielding an HttpCallResult for each.
+
+    A failed call is returned with its error rather than stopping the batch, so check result.error for each result.
+    Calls are read from the iterable as workers free up, so a generator of millions of calls is never held in memory.
+    calls = Iterable of dicts of send_http_call arguments, ex) {'method': 'get', 'url': f'{api_url}/records/{id}'}
+    max_workers = Number of calls in flight at once, keep at or below HTTP_POOL_MAXSIZE for calls to one host
+    ordered = True yields results in input order, False (default) yields them as they complete
+    max_pending = Calls queued or running at once (default: 2 * max_workers)
+
+    Example:
+        for result in lp_api.send_http_calls({'method': 'get', 'url': f'{api_url}/{id}'} for id in ids):
+            if result.error:
+                logger.error(f"{result.call['url']} failed: {result.error}")
+    '''
+    max_pending = max_pending or 2 * max_workers
+    calls = enumerate(calls)
+    with ThreadPoolExecutor(max_workers, thread_name_prefix='send_http_calls') as executor:
+        pending = deque() if ordered else set()
+
+        def fill():
+            for index, call in calls:
+                future = executor.submit(__send_batched_call, index, call)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+                if len(pending) >= max_pending:
+                    return
+
+        try:
+            fill()
+            while pending:
+                if ordered:
+                    result = pending.popleft().result()
+                    fill()
+                    yield result
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.difference_update(done)
+                    fill()
+                    for future in done:
+                        yield future.result()
+        finally:
+            for future in pending: #caller stopped early, don't start the rest
+                future.cancel()
+
 
 class AuthType(Enum):
     """Different authentication types supported by the AuthHandler.
@@ -76,6 +453,7 @@ class AuthType(Enum):
     OAUTH2 = 3 #TODO THIS DOES NOT WORK
 
 home_folder = Path.home()/".lp"
+CREDENTIAL_REFRESH_MARGIN = 60 #seconds before expiry that credentials are refreshed, so calls don't go out with a token about to lapse
 
 class AuthHandler:
     """Handles authentication for APIs."""
@@ -83,6 +461,7 @@ class AuthHandler:
         self.name = name
         self.auth_type = auth_type
         self.env_config = env_config
+        self._credentials_lock = threading.Lock()
         self.env = env
         self.credentials = None
 
@@ -160,8 +539,9 @@ class AuthHandler:
         """Clears credentials cached on disk and in memory"""
         Path(home_folder).mkdir(exist_ok=True)
         cached_credential_path = Path(home_folder) / f"{self.name}-{self.env}.json"
-        cached_credential_path.unlink()
-        self.credentials = None
+        with self._credentials_lock:
+            cached_credential_path.unlink()
+            self.credentials = None
 
     def _get_basic_auth_credentials(self):
         """Prompt for basic authentication credentials and return the username and auth string"""
@@ -197,34 +577,67 @@ class AuthHandler:
         return send_http_call(method='post', **token_params)
 
 
+    @staticmethod
+    def _credentials_valid(credentials, now:float, margin:float = 0) -> bool:
+        """True if credentials exist and don't expire within margin seconds of now, margin being capped at half the credentials' lifetime"""
+        if credentials is None:
+            return False
+        if not credentials.get('expiry'):
+            return True
+        if credentials.get('received'): #short lived tokens would otherwise be due for refresh as soon as they arrive
+            margin = min(margin, (credentials['expiry'] - credentials['received']) / 2)
+        return credentials['expiry'] - margin > now
+
+    def _new_credentials(self, now:int) -> dict:
+        """Get new authentication credentials for the auth type"""
+        credentials = {'received': now}
+        if self.auth_type == AuthType.BASIC:
+            credentials["username"], credentials["credstring"] = self._get_basic_auth_credentials()
+            credentials["auth_header"] = f"Basic {credentials.get('credstring')}"
+        elif self.auth_type == AuthType.JWT_BEARER:
+            credentials.update(self._request_token().json())
+            credentials['expiry'] = now + credentials.get('expires_in',3600)
+            credentials['auth_header'] = f"Bearer {credentials.get('access_token')}"
+        elif self.auth_type == AuthType.OAUTH2: #TODO THIS DOES NOT WORK
+            credentials["username"], credentials["credstring"] = self._get_basic_auth_credentials()
+            credentials["auth_header"] = f"Basic {credentials.get('credstring')}"
+            credentials = self._request_oauth2_token()
+            credentials['expiry'] = now + credentials.get('expires_in',3600)
+            credentials['auth_header'] = f"Bearer {credentials.get('access_token')}"
+        return credentials
+
     def get_valid_credentials(self):
         """
         Function that ensures the present authentication values are valid
         and not expired, and if they don't exists it gets some.
+
+        Valid credentials held in memory are returned without locking or touching disk. Credentials are refreshed
+        CREDENTIAL_REFRESH_MARGIN seconds (at most half their lifetime) before they expire, by one thread while the
+        others wait for its result, and written to disk only when they change.
         """
-        now = int(time())
-        if self.credentials is None:
-            logger.debug("Beginning loading of cached credentials")
-            self.credentials = self._get_cached_credentials()
-        if self.credentials is None or (self.credentials.get('expiry') and self.credentials.get('expiry',0) <= now):
+        credentials = self.credentials
+        if self._credentials_valid(credentials, time(), CREDENTIAL_REFRESH_MARGIN):
+            return credentials
+        with self._credentials_lock:
+            now = int(time())
+            if self.credentials is None:
+                logger.debug("Beginning loading of cached credentials")
+                self.credentials = self._get_cached_credentials()
+            if self._credentials_valid(self.credentials, now, CREDENTIAL_REFRESH_MARGIN):
+                HttpResponseCache.register_credentials(self.credentials.get('auth_header'), f"{self.name}-{self.env}")
+                return self.credentials #refreshed by another thread while we waited, or loaded from disk
             logger.debug('Getting new authentication credentials')
-            self.credentials = {}
-            self.credentials['received'] = now
-            if self.auth_type == AuthType.BASIC:
-                self.credentials["username"],self._credentials["credstring"] = self._get_basic_auth_credentials()
-                self.credentials["auth_header"] = f"Basic {self._credentials.get('credstring')}"
-            elif self.auth_type == AuthType.JWT_BEARER:
-                self.credentials = self._request_token()
-                self.credentials['expiry'] = now + self._credentials.get('expires_in',3600)
-                self.credentials['auth_header'] = f"Bearer {self._credentials.get('access_token')}"
-            elif self.auth_type == AuthType.OAUTH2: #TODO THIS DOES NOT WORK
-                self.credentials["username"], self._credentials["credstring"] = self._get_basic_auth_credentials()
-                self.credentials["auth_header"] = f"Basic {self._credentials.get('credstring')}"
-                self.credentials = self._request_oauth2_token()
-                self.credentials['expiry'] = now + self._credentials.get('expires_in',3600)
-                self.credentials['auth_header'] = f"Bearer {self._credentials.get('access_token')}"
-        self._cache_credentials()
-        return self.credentials
+            try:
+                credentials = self._new_credentials(now)
+            except Exception:
+                if not self._credentials_valid(self.credentials, now):
+                    raise
+                logger.warning(f'Could not refresh credentials for {self.name} {self.env}, using the current ones until they expire')
+                return self.credentials
+            HttpResponseCache.register_credentials(credentials.get('auth_header'), f"{self.name}-{self.env}", (self.credentials or {}).get('auth_header'))
+            self.credentials = credentials
+            self._cache_credentials()
+            return credentials
 
     def manage_auth(self, func):
         """Decorator to handle authentication"""
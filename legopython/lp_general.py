@@ -1,6 +1,11 @@
 '''A place to store legoPython functions that have general usability across modules, but aren't necessarily specific to any one module'''
 import csv
+import fnmatch
+import os
+import queue
+import threading
 from pathlib import Path
+from typing import Generator, NamedTuple
 from distutils.util import strtobool
 from legopython.lp_logging import logger
 
@@ -24,6 +29,121 @@ def listdir_path(file:str):
         yield from [ f for f in Path(fpath.parent).glob(fpath.name) if f.is_file() ]
 
 
+class LocalFile(NamedTuple):
+    '''A file found by listdir_path_v2, with the size and mtime read while scanning its directory'''
+    path: Path
+    relpath: str #path relative to the walked folder, '/' separated so it can be used as an S3 key suffix
+    size: int
+    mtime: float
+
+
+def __path_matches(relpath:str, patterns) -> bool:
+    '''True if a '/' separated relative path, or its final component, matches any of the fnmatch patterns'''
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def listdir_path_v2(file:str, recursive:bool = True, include:list = None, exclude:list = None, walkWorkers:int = 8, maxQueued:int = 10000) -> Generator[LocalFile, None, None]:
+    '''Given an input of file, directory, or file glob, return a generator of LocalFile tuples (path, relpath, size, mtime).
+    Directories are read with os.scandir by walkWorkers threads in parallel and files are yielded as soon as they are
+    found, so the caller can start working on a tree of millions of files straight away. Files come out in no particular order.
+    file - The file/directory/glob to walk, a glob only matches files directly inside its folder
+    recursive (opt) - descend into subdirectories (default = True)
+    include (opt) - fnmatch patterns, only files whose relative path or name matches one of them are returned
+    exclude (opt) - fnmatch patterns, files and directories whose relative path or name matches one of them are skipped
+    walkWorkers (opt) - number of directories scanned at once (default = 8)
+    maxQueued (opt) - files found but not yet consumed before the walk pauses (default = 10000)
+    '''
+    fpath = Path(file)
+    include = list(include or [])
+    exclude = list(exclude or [])
+    if fpath.is_file() :
+        logger.debug("file is a single file")
+        filestat = fpath.stat()
+        yield LocalFile(fpath, fpath.name, filestat.st_size, filestat.st_mtime)
+        return
+    if not fpath.is_dir() :
+        logger.debug("file is neither file or directory, assuming fileglob")
+        globpattern = fpath.name
+        fpath = fpath.parent
+        recursive = False
+    else :
+        globpattern = None
+        logger.debug("file is a directory")
+
+    directories = queue.Queue()
+    found = queue.Queue(maxQueued)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [1] #directories queued or being scanned, the walk is finished when it reaches 0
+
+    def send(item) -> bool:
+        '''Hand an item to the consumer, giving up if it has stopped reading'''
+        while not stop.is_set() :
+            try:
+                found.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan(directory:str, reldir:str):
+        with os.scandir(directory) as entries :
+            for entry in entries :
+                relpath = reldir + entry.name
+                if exclude and __path_matches(relpath, exclude) :
+                    continue
+                if entry.is_dir(follow_symlinks=False) : #symlinked directories aren't followed, so the walk can't loop
+                    if recursive :
+                        with lock:
+                            pending[0] += 1
+                        directories.put((entry.path, relpath + '/'))
+                elif entry.is_file() :
+                    if globpattern is not None and not fnmatch.fnmatch(entry.name, globpattern) :
+                        continue
+                    if include and not __path_matches(relpath, include) :
+                        continue
+                    try:
+                        filestat = entry.stat() #cached by scandir on Windows, a single stat elsewhere
+                    except OSError as e: #deleted or unreadable since the directory was listed, carry on with the rest
+                        logger.debug(f"Function listdir_path_v2 - skipping {entry.path}: {e}")
+                        continue
+                    if not send(LocalFile(Path(entry.path), relpath, filestat.st_size, filestat.st_mtime)) :
+                        return
+
+    def worker():
+        while True :
+            item = directories.get()
+            if item is None or stop.is_set() :
+                return
+            try:
+                scan(*item)
+            except OSError as e:
+                logger.warning(f"Function listdir_path_v2 - unable to read directory {item[0]}: {e}")
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished :
+                for _ in threads :
+                    directories.put(None)
+                send(None)
+
+    directories.put((str(fpath), ''))
+    threads = [threading.Thread(target=worker, daemon=True, name=f'listdir_path_v2-{i}') for i in range(max(walkWorkers, 1))]
+    for thread in threads :
+        thread.start()
+    try:
+        while True :
+            item = found.get()
+            if item is None :
+                return
+            yield item
+    finally:
+        stop.set() #consumer finished or stopped early, release the workers
+        for _ in threads :
+            directories.put(None)
+
+
 def prompt_user_yesno(question, default='no') :
     if default == 'yes' :
         prompt = ' [Y/n] '
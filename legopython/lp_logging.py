@@ -12,6 +12,9 @@ Console prints the lowest level set in lp_settings.LOGGER_LEVEL
 '''
 import sys
 import logging
+import sqlite3
+import threading
+from pathlib import Path
 from legopython import lp_settings
 logger = logging.getLogger("legopython")
 
@@ -37,6 +40,148 @@ def __test_logging():
     logger.critical('critical message')
 
 
+class FileLedger:
+    '''
+    FileLedger - SQLite backed record of files moved between S3 and the local filesystem, one row per S3 url holding
+    the ETag, size, mtime and local folder of the last transfer. Used by lp_s3.sync to skip files that haven't changed.
+    A single connection is shared between threads and guarded by a lock, use get_file_ledger() to share one per path.
+        fileledgerpath - path of the SQLite database, created if it doesn't exist
+    '''
+    def __init__(self, fileledgerpath):
+        self.fileledgerpath = Path(fileledgerpath)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.fileledgerpath), check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL') #readers don't block the transfer threads writing
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS file_ledger (
+                s3url TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                localpath TEXT,
+                mtime REAL,
+                size INTEGER,
+                etag TEXT
+            )''')
+
+    def record(self, filename:str, s3url:str, localpath, mtime:float, size:int, etag:str = None):
+        '''Insert or replace the ledger entry for s3url'''
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO file_ledger (s3url, filename, localpath, mtime, size, etag) VALUES (?, ?, ?, ?, ?, ?)',
+                (s3url, filename, str(localpath), mtime, size, etag)
+            )
+
+    def get(self, s3url:str) -> dict:
+        '''Return the ledger entry for s3url as a dict, or None if it has never been recorded'''
+        with self._lock:
+            row = self._connection.execute('SELECT * FROM file_ledger WHERE s3url = ?', (s3url,)).fetchone()
+        return dict(row) if row else None
+
+    def close(self):
+        '''Close the underlying SQLite connection'''
+        with self._lock:
+            self._connection.close()
+
+
+__file_ledgers = {}
+__file_ledgers_lock = threading.Lock()
+
+
+def get_file_ledger(fileledgerpath) -> FileLedger:
+    '''Return the shared FileLedger for fileledgerpath, opening it on first use'''
+    ledgerkey = str(Path(fileledgerpath).resolve())
+    with __file_ledgers_lock:
+        if ledgerkey not in __file_ledgers:
+            __file_ledgers[ledgerkey] = FileLedger(ledgerkey)
+        return __file_ledgers[ledgerkey]
+
+
+def writeToFileLedger(filename:str, s3url:str, localpath, mtime:float, size:int, fileledgerpath, etag:str = None):
+    '''
+    writeToFileLedger - Record a transferred file in the SQLite file ledger at fileledgerpath
+        filename - name of the file
+        s3url - full s3:// url of the object
+        localpath - local folder the file was read from or written to
+        mtime - modified time of the file in seconds since the epoch
+        size - size of the file in bytes
+        fileledgerpath - path of the SQLite ledger
+        etag (opt) - S3 ETag of the object
+    '''
+    get_file_ledger(fileledgerpath).record(filename, s3url, localpath, mtime, size, etag)
+
+
+class TransferJournal:
+    '''
+    TransferJournal - SQLite backed checkpoint of resumable bulk transfers (see lp_s3 getS3Files/copyFilesInS3 journal=).
+    Each job keeps the listing continuation token up to which every key has been transferred, plus the keys already
+    finished beyond that token, so a rerun of an interrupted job lists from the token and skips the finished keys.
+        journalpath - path of the SQLite database, created if it doesn't exist
+    '''
+    def __init__(self, journalpath):
+        self.journalpath = Path(journalpath)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.journalpath), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS journal_state (
+                job TEXT PRIMARY KEY,
+                continuation_token TEXT
+            )''')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS journal_keys (
+                job TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (job, key)
+            )''')
+
+    def get_token(self, job:str) -> str:
+        '''Return the continuation token job should resume listing from, None to list from the start'''
+        with self._lock:
+            row = self._connection.execute('SELECT continuation_token FROM journal_state WHERE job = ?', (job,)).fetchone()
+        return row[0] if row else None
+
+    def completed_keys(self, job:str) -> set:
+        '''Return the keys job finished beyond its continuation token'''
+        with self._lock:
+            return {row[0] for row in self._connection.execute('SELECT key FROM journal_keys WHERE job = ?', (job,))}
+
+    def record_key(self, job:str, key:str):
+        '''Record key as finished by job'''
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR IGNORE INTO journal_keys (job, key) VALUES (?, ?)', (job, key))
+
+    def checkpoint(self, job:str, token:str, keys:list):
+        '''Move job's continuation token forward, forgetting the finished keys the new token already skips'''
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO journal_state (job, continuation_token) VALUES (?, ?)', (job, token))
+            self._connection.executemany('DELETE FROM journal_keys WHERE job = ? AND key = ?', ((job, key) for key in keys))
+
+    def finish(self, job:str):
+        '''Forget job once it has completed, so the next run starts from the beginning'''
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM journal_state WHERE job = ?', (job,))
+            self._connection.execute('DELETE FROM journal_keys WHERE job = ?', (job,))
+
+    def close(self):
+        '''Close the underlying SQLite connection'''
+        with self._lock:
+            self._connection.close()
+
+
+__transfer_journals = {}
+__transfer_journals_lock = threading.Lock()
+
+
+def get_transfer_journal(journalpath) -> TransferJournal:
+    '''Return the shared TransferJournal for journalpath, opening it on first use'''
+    journalkey = str(Path(journalpath).resolve())
+    with __transfer_journals_lock:
+        if journalkey not in __transfer_journals:
+            __transfer_journals[journalkey] = TransferJournal(journalkey)
+        return __transfer_journals[journalkey]
+
+
 #Configures how console print outs through std.out'''
 __console_log_handler(lp_settings.LOGGER_LEVEL.upper())
 
@@ -7,24 +7,233 @@ Examples:
 '''
 
 import argparse
+import bisect
+import io
+import os
+import queue
+import random
 import sys
+import threading
+import time
 import traceback
 import datetime
+import gzip
+import hashlib
+import zlib
 from pathlib import Path
 from typing import Generator
 import logging
+from collections import OrderedDict, deque
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor
 import boto3
+import boto3.s3.transfer
 import botocore
-from legopython import lp_logging, lp_general, lp_awssession
+from legopython import lp_logging, lp_general, lp_awssession, lp_settings
 from legopython.lp_logging import logger
+try :
+    import zstandard #optional, only needed for zstd compressed objects (pip install zstandard)
+except ImportError :
+    zstandard = None
+
+#Objects larger than DOWNLOAD_PART_SIZE are split into byte ranges and fetched by DOWNLOAD_PART_WORKERS threads
+DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+DOWNLOAD_PART_WORKERS = 10
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+#Files larger than UPLOAD_MULTIPART_THRESHOLD are sent as a multipart upload of UPLOAD_PART_SIZE parts, UPLOAD_PART_WORKERS at a time
+UPLOAD_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_PART_WORKERS = 10
+
+#Objects of at least COPY_MULTIPART_THRESHOLD are copied server side as COPY_PART_SIZE UploadPartCopy parts, COPY_PART_WORKERS at a time
+COPY_MULTIPART_THRESHOLD = 128 * 1024 * 1024
+COPY_PART_SIZE = 64 * 1024 * 1024
+COPY_PART_WORKERS = 10
+
+#DeleteObjects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+#Parallel listing: how many pages of the top level are read looking for CommonPrefixes to shard on, the most distinct
+#next characters probed for when splitting a flat key space into ranges, and how many pages each shard may buffer
+LIST_DISCOVERY_PAGES = 10
+LIST_SPLIT_MAX_CHARS = 128
+LIST_QUEUE_PAGES = 4
+
+#Error codes S3 uses to ask clients to slow down, retried with backoff by adaptive transfers
+THROTTLE_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled', '503'}
+
+#keys_exist answers folders with at least KEYS_EXIST_LIST_MIN requested keys from a listing, which is abandoned for HEADs
+#once it costs more than one page per KEYS_EXIST_KEYS_PER_PAGE requested keys
+KEYS_EXIST_LIST_MIN = 8
+KEYS_EXIST_KEYS_PER_PAGE = 10
+
+#write_file_to_S3/getS3FileContents compress and decompress in chunks of COMPRESSION_CHUNK_SIZE, choosing the codec
+#from the object's Content-Encoding or these key extensions
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+
+#Default client config, sized for the thread pools used by the bulk transfer functions
+S3_CLIENT_CONFIG = botocore.client.Config(max_pool_connections=200)
 
-AWS_REGION = 'us-east-1'
+logger = logging.getLogger("python")
 
-s3 = boto3.resource('s3')
-s3c = boto3.client('s3', config=botocore.client.Config(max_pool_connections=200))
+__s3_clients = {}
+__s3_clients_lock = threading.Lock()
 
-logger = logging.getLogger("python")
+
+def __get_s3_service(kind:str, region:str = None, profile:str = None, config:botocore.client.Config = None):
+    '''Return the shared boto3 S3 client or resource for region/profile/config, creating it on first use'''
+    region = region or lp_settings.AWS_REGION #read on every call so a region changed in lp_settings is picked up
+    config = config or S3_CLIENT_CONFIG
+    registrykey = (kind, region, profile, config) #Config objects hash by identity, so reuse the same object to share a client
+    service = __s3_clients.get(registrykey)
+    if service is None:
+        with __s3_clients_lock:
+            service = __s3_clients.get(registrykey)
+            if service is None: #boto3 sessions aren't thread-safe, so clients are only ever created under the lock
+                session = boto3.Session(profile_name=profile, region_name=region)
+                service = session.client('s3', config=config) if kind == 'client' else session.resource('s3', config=config)
+                __s3_clients[registrykey] = service
+                logger.debug(f'Created boto3 S3 {kind} for region {region}, profile {profile}')
+    return service
+
+
+def get_s3_client(region:str = None, profile:str = None, config:botocore.client.Config = None):
+    '''
+    get_s3_client - Return the shared, thread-safe boto3 S3 client for region/profile/config. Clients are created on
+    first use and reused by every lp_s3 function afterwards.
+        region (opt) - AWS region (default = lp_settings.AWS_REGION)
+        profile (opt) - AWS profile name (default = the default credential chain)
+        config (opt) - botocore Config (default = S3_CLIENT_CONFIG)
+    '''
+    return __get_s3_service('client', region, profile, config)
+
+
+def get_s3_resource(region:str = None, profile:str = None, config:botocore.client.Config = None):
+    '''get_s3_resource - Return the shared boto3 S3 resource for region/profile/config, see get_s3_client'''
+    return __get_s3_service('resource', region, profile, config)
+
+
+def __getattr__(name:str):
+    '''Keep lp_s3.s3, lp_s3.s3c and lp_s3.AWS_REGION working for callers, without creating or copying them at import time'''
+    if name == 'AWS_REGION':
+        return lp_settings.AWS_REGION
+    if name == 's3c':
+        return get_s3_client()
+    if name == 's3':
+        return get_s3_resource()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class S3MetadataCache:
+    '''
+    S3MetadataCache - Thread-safe, TTL bounded LRU cache of listing and HEAD results, keyed by bucket and prefix/key.
+    Entries are dropped after ttl seconds, the least recently used entry is evicted past maxEntries, and lp_s3's own
+    upload/copy/write/delete functions invalidate the entries for the keys they change. Turn on with enable_metadata_cache().
+        ttl (opt) - seconds an entry is served from memory (default = 300)
+        maxEntries (opt) - maximum number of cached listings/HEAD results (default = 10000)
+        maxListingSize (opt) - listings of more objects than this are streamed without being cached (default = 10000)
+    '''
+    def __init__(self, ttl:float = 300, maxEntries:int = 10000, maxListingSize:int = 10000):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.maxListingSize = maxListingSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._listings = {} #bucket: {prefix: cache keys of the listings of that prefix}, so invalidate() doesn't scan every entry
+        self._lock = threading.Lock()
+
+    def _drop(self, cachekey:tuple):
+        '''Remove cachekey and its listing index entry, the caller holds the lock'''
+        if self._entries.pop(cachekey, None) is None or cachekey[0] == 'head':
+            return
+        prefixes = self._listings[cachekey[1]]
+        prefixes[cachekey[2]].discard(cachekey)
+        if not prefixes[cachekey[2]]:
+            del prefixes[cachekey[2]]
+            if not prefixes:
+                del self._listings[cachekey[1]]
+
+    def get(self, cachekey:tuple):
+        '''Return the cached value for cachekey, or None if it isn't cached or has expired'''
+        with self._lock:
+            entry = self._entries.get(cachekey)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(cachekey)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cachekey)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, cachekey:tuple, value):
+        '''Cache value for cachekey, evicting the least recently used entries past maxEntries'''
+        with self._lock:
+            self._entries[cachekey] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(cachekey)
+            if cachekey[0] != 'head':
+                self._listings.setdefault(cachekey[1], {}).setdefault(cachekey[2], set()).add(cachekey)
+            while len(self._entries) > self.maxEntries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, bucket:str, keys):
+        '''Drop the HEAD results for keys and every listing of bucket whose prefix contains any of them'''
+        with self._lock:
+            prefixes = self._listings.get(bucket, {})
+            for key in keys:
+                self._drop(('head', bucket, key))
+                if not prefixes :
+                    continue
+                for end in range(len(key) + 1): #every prefix of key a listing could have been cached under
+                    for cachekey in list(prefixes.get(key[:end], ())):
+                        self._drop(cachekey)
+
+    def clear(self):
+        '''Drop every cached entry'''
+        with self._lock:
+            self._entries.clear()
+            self._listings.clear()
+
+
+__metadata_cache = None
+
+
+def enable_metadata_cache(ttl:float = 300, maxEntries:int = 10000, maxListingSize:int = 10000) -> S3MetadataCache:
+    '''
+    enable_metadata_cache - Answer repeated listMatchingS3Keys, listDirectories and object_key_exists calls from memory
+        ttl (opt) - seconds an entry is served from memory (default = 300)
+        maxEntries (opt) - maximum number of cached listings/HEAD results (default = 10000)
+        maxListingSize (opt) - listings of more objects than this are streamed without being cached (default = 10000)
+
+    Returns - the S3MetadataCache now in use (hits/misses counters, clear())
+    '''
+    global __metadata_cache
+    __metadata_cache = S3MetadataCache(ttl, maxEntries, maxListingSize)
+    return __metadata_cache
+
+
+def disable_metadata_cache():
+    '''Stop caching listings and HEAD results and drop anything cached'''
+    global __metadata_cache
+    __metadata_cache = None
+
+
+def __cache_get(cachekey:tuple):
+    return __metadata_cache.get(cachekey) if __metadata_cache is not None else None
+
+
+def __cache_put(cachekey:tuple, value):
+    if __metadata_cache is not None:
+        __metadata_cache.put(cachekey, value)
+
+
+def __cache_invalidate(bucket:str, *keys):
+    '''Called by every lp_s3 function that writes, copies or deletes keys'''
+    if __metadata_cache is not None:
+        __metadata_cache.invalidate(bucket, keys)
 
 
 def s3url_cleaner(s3url:str) -> str:
@@ -47,7 +256,7 @@ def return_s3bucket(s3url:str):
     return - S3 Bucket
     '''
     spliturl = s3url_cleaner(s3url).split('/') #[0] is the bucket, [1:] is the key
-    return s3.Bucket(spliturl[0])
+    return get_s3_resource().Bucket(spliturl[0])
 
 
 def return_s3path(s3url) :
@@ -94,61 +303,1047 @@ def return_s3folderpath(key, bucket=True) :
     return key.rsplit('/', 1)[0] + '/'
 
 
-def __getAS3File(bucket, key, downloadfolder = '.', delete = False, fileLedger = None, contents = False) :
+class TransferMetrics:
+    '''
+    TransferMetrics - Live counters for a bulk transfer, updated by BoundedTaskPool as tasks are queued, start and finish.
+    Latencies go into a fixed set of geometric buckets (10% wide), so recording is O(log buckets) with constant memory
+    and percentiles are accurate to within a bucket. Safe to read from another thread while the transfer runs.
+        progressCallback (opt) - called with snapshot() from a worker thread at most every progressInterval seconds
+        progressInterval (opt) - seconds between progressCallback calls (default = 5)
+
+    Pass the same instance to getS3Files/sendFilesToS3/copyFilesInS3 (metrics=...) to watch a run, the end of run
+    summary is summary() (also available as TaskResults.metrics).
+    '''
+    LATENCY_BUCKETS = [0.001 * 1.1 ** i for i in range(220)] #1ms to ~3.5 hours
+
+    def __init__(self, progressCallback = None, progressInterval:float = 5):
+        self.progressCallback = progressCallback
+        self.progressInterval = progressInterval
+        self.files_queued = 0
+        self.files_running = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.files_cancelled = 0
+        self.files_skipped = 0
+        self.bytes_pending = 0
+        self.bytes_done = 0
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self._latency_counts = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self._last_progress = self.start_time
+        self._lock = threading.Lock()
+
+    def task_queued(self, size:int = None):
+        '''A task was handed to the pool'''
+        with self._lock:
+            self.files_queued += 1
+            self.bytes_pending += size or 0
+
+    def task_started(self):
+        '''A worker picked a queued task up'''
+        with self._lock:
+            self.files_queued -= 1
+            self.files_running += 1
+
+    def task_finished(self, latency:float, size:int = None, failed:bool = False, skipped:bool = False):
+        '''A running task finished after latency seconds, skipped tasks (nothing to transfer) are left out of the rates'''
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, latency)
+        now = time.monotonic()
+        with self._lock:
+            self.files_running -= 1
+            self.bytes_pending -= size or 0
+            if skipped:
+                self.files_skipped += 1
+            elif failed:
+                self.files_failed += 1
+            else:
+                self.files_done += 1
+                self.bytes_done += size or 0
+            if not skipped:
+                self._latency_counts[bucket] += 1
+            report = self.progressCallback is not None and now - self._last_progress >= self.progressInterval
+            if report:
+                self._last_progress = now
+        if report:
+            self.progressCallback(self.snapshot())
+
+    def task_cancelled(self, size:int = None):
+        '''A queued task was dropped without running'''
+        with self._lock:
+            self.files_queued -= 1
+            self.files_cancelled += 1
+            self.bytes_pending -= size or 0
+
+    def finish(self):
+        '''Stop the clock used for MBps'''
+        self.end_time = time.monotonic()
+
+    def latency_percentile(self, percentile:float) -> float:
+        '''Return the per-object latency in seconds at percentile (0-100), None if nothing has finished'''
+        with self._lock:
+            counts = list(self._latency_counts)
+        total = sum(counts)
+        if total == 0:
+            return None
+        target = total * percentile / 100
+        running = 0
+        for bucket, count in enumerate(counts):
+            running += count
+            if running >= target:
+                return self.LATENCY_BUCKETS[min(bucket, len(self.LATENCY_BUCKETS) - 1)]
+        return self.LATENCY_BUCKETS[-1]
+
+    def snapshot(self) -> dict:
+        '''Return the current counters, elapsed seconds, MBps and p50/p99 latency as a dict'''
+        with self._lock:
+            counters = {
+                'files_queued': self.files_queued,
+                'files_running': self.files_running,
+                'files_done': self.files_done,
+                'files_failed': self.files_failed,
+                'files_cancelled': self.files_cancelled,
+                'files_skipped': self.files_skipped,
+                'bytes_pending': self.bytes_pending,
+                'bytes_done': self.bytes_done,
+            }
+        elapsed = (self.end_time or time.monotonic()) - self.start_time
+        counters['seconds'] = elapsed
+        counters['MBps'] = counters['bytes_done'] / 1048576 / max(elapsed, 1e-6)
+        counters['p50_latency'] = self.latency_percentile(50)
+        counters['p99_latency'] = self.latency_percentile(99)
+        return counters
+
+    def summary(self) -> dict:
+        '''End of run summary, the snapshot() taken once the run has finished'''
+        if self.end_time is None:
+            self.finish()
+        return self.snapshot()
+
+
+def is_throttle_error(error:Exception) -> bool:
+    '''Return True if error is S3 asking us to slow down (SlowDown/503 and friends)'''
+    if isinstance(error, botocore.exceptions.ClientError):
+        return error.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES
+    #s3transfer wraps the ClientError of a failed upload/download in its own exception, so fall back to the message
+    return any(code in str(error) for code in ('SlowDown', 'Throttl', 'RequestLimitExceeded'))
+
+
+class AdaptiveConcurrency:
+    '''
+    AdaptiveConcurrency - AIMD limit on the number of requests in flight, shared by the workers of a BoundedTaskPool.
+    The limit grows by one for every `limit` successful tasks while latency stays within latencyTolerance of the
+    baseline, shrinks by one when latency climbs past it, and is cut by backoffFactor (at most once per cooldown
+    seconds) when S3 throttles. Latency is measured per MB for tasks over 1MB so larger objects don't read as congestion,
+    and the baseline is the best average seen drifting slowly towards the current one, so a lasting change in object
+    sizes or network resets it instead of pinning the limit at minLimit. Throttled tasks are retried with exponential
+    backoff and full jitter.
+        maxLimit - upper bound on the requests in flight (the pool's poolWorkers)
+        initialLimit (opt) - starting limit (default = maxLimit / 4)
+        minLimit (opt) - lower bound on the limit (default = 1)
+        maxRetries (opt) - times a throttled task is retried before it fails (default = 8)
+        latencyTolerance (opt) - latency, relative to the best average seen, above which the limit stops growing (default = 2)
+        backoffFactor (opt) - multiplier applied to the limit on throttling (default = 0.7)
+    '''
+    def __init__(self, maxLimit:int, initialLimit:int = None, minLimit:int = 1, maxRetries:int = 8, latencyTolerance:float = 2, backoffFactor:float = 0.7, cooldown:float = 1):
+        self.maxLimit = maxLimit
+        self.minLimit = minLimit
+        self.limit = initialLimit or max(minLimit, maxLimit // 4)
+        self.maxRetries = maxRetries
+        self.latencyTolerance = latencyTolerance
+        self.backoffFactor = backoffFactor
+        self.cooldown = cooldown
+        self.throttles = 0
+        self.in_flight = 0
+        self._limit = float(self.limit)
+        self._latency = None
+        self._best_latency = None
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        '''Block until fewer than limit requests are in flight'''
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _set_limit(self, limit:float):
+        self._limit = min(max(limit, self.minLimit), self.maxLimit)
+        self.limit = int(self._limit)
+        self._condition.notify_all()
+
+    def on_success(self, latency:float, size:int = None):
+        '''Record a successful request of size bytes, growing (or trimming) the limit based on its latency'''
+        if size:
+            latency /= max(size / (1024 * 1024), 1) #seconds per MB, small requests are dominated by per-request overhead
+        with self._condition:
+            self._latency = latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+            if self._best_latency is None or self._latency < self._best_latency:
+                self._best_latency = self._latency
+            else:
+                self._best_latency += 0.01 * (self._latency - self._best_latency)
+            if self._latency > self._best_latency * self.latencyTolerance:
+                self._set_limit(self._limit - 1 / self.limit)
+            else:
+                self._set_limit(self._limit + 1 / self.limit)
+
+    def on_throttle(self):
+        '''Record a throttled request, cutting the limit unless it was cut within the last cooldown seconds'''
+        with self._condition:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                self._set_limit(self._limit * self.backoffFactor)
+                logger.debug(f'AdaptiveConcurrency - throttled, limit now {self.limit}')
+
+    def backoff(self, attempt:int) -> float:
+        '''Seconds to wait before retry number attempt (exponential with full jitter, capped at 20s)'''
+        return random.uniform(0, min(20, 0.25 * 2 ** attempt))
+
+
+#Returned by a BoundedTaskPool task that found nothing to transfer, counted in TaskResults.skipped rather than as a transfer
+TASK_SKIPPED = object()
+
+
+class TaskResults:
+    '''
+    TaskResults - Outcome of a batch of tasks run through a BoundedTaskPool
+        submitted - number of tasks handed to the pool
+        results - return values of the tasks that succeeded (None return values are not kept)
+        skipped - number of tasks that returned TASK_SKIPPED
+        errors - list of (args, exception) tuples for tasks that raised
+        cancelled - True if the run was interrupted (Ctrl-C) before every task was submitted/run
+        metrics - TransferMetrics of the run, see metrics.summary()
+
+    Evaluates True when at least one task was submitted and none of them failed.
+    '''
+    def __init__(self, metrics:TransferMetrics = None):
+        self.submitted = 0
+        self.results = []
+        self.skipped = 0
+        self.errors = []
+        self.cancelled = False
+        self.metrics = metrics or TransferMetrics()
+
+    def __bool__(self):
+        return self.submitted > 0 and not self.errors
+
+    def __repr__(self):
+        return f'TaskResults(submitted={self.submitted}, results={len(self.results)}, errors={len(self.errors)}, cancelled={self.cancelled})'
+
+
+class BoundedTaskPool:
+    '''
+    BoundedTaskPool - ThreadPool wrapper where submit() blocks once maxPending tasks are queued or running, so a
+    producer such as listMatchingS3Keys is paused (backpressure) instead of queueing a closure for every key up front.
+    Return values and exceptions of every task are collected in a TaskResults returned by join().
+        poolWorkers (opt) - number of worker threads, 1 runs each task inline on the calling thread (default = 100)
+        maxPending (opt) - maximum number of tasks queued or running at once (default = 2 * poolWorkers)
+        metrics (opt) - TransferMetrics to record progress on (default = a new TransferMetrics)
+        adaptive (opt) - AdaptiveConcurrency limiting how many of the poolWorkers threads run at once and retrying
+                    throttled tasks with backoff (default = None, all poolWorkers run and errors aren't retried)
+
+    Example:
+        pool = BoundedTaskPool(poolWorkers)
+        try:
+            for key in listMatchingS3Keys(s3url):
+                pool.submit(func, key)
+        except KeyboardInterrupt:
+            pool.cancel()
+        except Exception:
+            pool.cancel()
+            raise
+        finally:
+            results = pool.join()
+    '''
+    def __init__(self, poolWorkers:int = 100, maxPending:int = None, metrics:TransferMetrics = None, adaptive:AdaptiveConcurrency = None):
+        self.poolWorkers = poolWorkers
+        self.adaptive = adaptive
+        self.taskresults = TaskResults(metrics)
+        self.metrics = self.taskresults.metrics
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._slots = threading.BoundedSemaphore(maxPending or 2 * max(poolWorkers, 1))
+        self._pool = ThreadPool(poolWorkers) if poolWorkers > 1 else None
+
+    def _run(self, func, args, kwargs, taskBytes):
+        try:
+            if self._cancelled.is_set(): #queued before Ctrl-C, don't start it
+                self.metrics.task_cancelled(taskBytes)
+                return
+            self.metrics.task_started()
+            start_time = time.monotonic()
+            failed = True
+            result = None
+            try:
+                result = self._call(func, args, kwargs, taskBytes) if self.adaptive is not None else func(*args, **kwargs)
+                failed = False
+            finally:
+                self.metrics.task_finished(time.monotonic() - start_time, taskBytes, failed, result is TASK_SKIPPED)
+        except Exception as e:
+            logger.debug(f'BoundedTaskPool - {getattr(func, "__name__", func)}{args} failed with error {e}')
+            with self._lock:
+                self.taskresults.errors.append((args, e))
+        else:
+            if result is TASK_SKIPPED:
+                with self._lock:
+                    self.taskresults.skipped += 1
+            elif result is not None:
+                with self._lock:
+                    self.taskresults.results.append(result)
+        finally:
+            if self._pool is not None:
+                self._slots.release()
+
+    def _call(self, func, args, kwargs, taskBytes:int = None):
+        '''Run func inside the adaptive concurrency limit, retrying it with backoff while S3 throttles'''
+        attempt = 0
+        while True:
+            self.adaptive.acquire()
+            start_time = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttle_error(e) or attempt >= self.adaptive.maxRetries or self._cancelled.is_set():
+                    raise
+                self.adaptive.on_throttle()
+            else:
+                self.adaptive.on_success(time.monotonic() - start_time, taskBytes)
+                return result
+            finally:
+                self.adaptive.release()
+            attempt += 1
+            time.sleep(self.adaptive.backoff(attempt))
+
+    def submit(self, func, *args, taskBytes:int = None, **kwargs):
+        '''
+        Run func(*args, **kwargs) on the pool, blocking while maxPending tasks are already outstanding
+            taskBytes (opt) - size of the object the task transfers, for the byte counters in metrics
+        '''
+        if self._cancelled.is_set():
+            raise RuntimeError('BoundedTaskPool has been cancelled')
+        self.taskresults.submitted += 1
+        self.metrics.task_queued(taskBytes)
+        if self._pool is None:
+            self._run(func, args, kwargs, taskBytes)
+            return
+        self._slots.acquire()
+        self._pool.apply_async(self._run, (func, args, kwargs, taskBytes))
+
+    def cancel(self):
+        '''Stop tasks that have not started yet, tasks already running are allowed to finish'''
+        self._cancelled.set()
+        self.taskresults.cancelled = True
+
+    def join(self) -> TaskResults:
+        '''Wait for all outstanding tasks to finish and return their TaskResults'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self.metrics.finish()
+        return self.taskresults
+
+
+class S3DeleteError(Exception):
+    '''Exception describing a key that a batched DeleteObjects request could not remove'''
+    def __init__(self, bucket:str, key:str, code:str, message:str = ''):
+        self.bucket = bucket
+        self.key = key
+        self.code = code
+        super().__init__(f'Deleting {bucket}/{key} failed with {code}: {message}')
+
+
+class BatchDeleter:
+    '''
+    BatchDeleter - Thread-safe collector of keys to delete. Keys are buffered per bucket and removed with one
+    DeleteObjects request per batchSize keys instead of one DeleteObject request per key. Call flush() (or use as a
+    context manager) once all keys have been added to delete the remainder.
+        batchSize (opt) - keys per DeleteObjects request, at most DELETE_BATCH_SIZE (default = DELETE_BATCH_SIZE)
+
+    After flush(), .deleted is the number of keys removed and .errors a list of S3DeleteError for keys that were not.
+    '''
+    def __init__(self, batchSize:int = DELETE_BATCH_SIZE):
+        self.batchSize = min(batchSize, DELETE_BATCH_SIZE)
+        self.deleted = 0
+        self.errors = []
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.flush()
+
+    def add(self, bucket:str, key:str):
+        '''Queue bucket/key for deletion, sending a DeleteObjects request once batchSize keys are queued for the bucket'''
+        with self._lock:
+            keys = self._pending.setdefault(bucket, [])
+            keys.append(key)
+            if len(keys) < self.batchSize:
+                return
+            self._pending[bucket] = []
+        self._delete(bucket, keys)
+
+    def flush(self) -> list:
+        '''Delete every queued key and return the list of S3DeleteError collected so far'''
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for bucket, keys in pending.items():
+            if keys:
+                self._delete(bucket, keys)
+        return self.errors
+
+    def _delete(self, bucket:str, keys:list):
+        errors = [S3DeleteError(bucket, error['Key'], error['Code'], error.get('Message', '')) for error in delete_keys(bucket, keys)]
+        with self._lock:
+            self.deleted += len(keys) - len(errors)
+            self.errors.extend(errors)
+
+
+def __check_codec(codec:str) -> str:
+    '''Return codec if this install can handle it'''
+    if codec == 'zstd' and zstandard is None :
+        raise ImportError('zstd compression needs the zstandard package, pip install zstandard')
+    return codec
+
+
+def __write_codec(key:str, compression:str) -> str:
+    '''Codec write_file_to_S3 compresses with: None, 'gzip', 'zstd', or 'auto' to pick from the key's extension'''
+    if compression == 'auto' :
+        compression = COMPRESSION_EXTENSIONS.get(Path(key).suffix.lower())
+    if compression not in (None, 'gzip', 'zstd') :
+        raise ValueError(f"Unsupported compression '{compression}', use None, 'gzip', 'zstd' or 'auto'")
+    return __check_codec(compression) if compression else None
+
+
+def __read_codec(key:str, contentEncoding:str, decompress) -> str:
+    '''Codec to decompress an object with: its Content-Encoding, or with decompress=True also its key's extension'''
+    if decompress is False :
+        return None
+    codec = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}.get((contentEncoding or '').lower())
+    if codec is None and decompress :
+        codec = COMPRESSION_EXTENSIONS.get(Path(key).suffix.lower())
+    return __check_codec(codec) if codec else None
+
+
+def __decompress_chunks(chunks, codec:str) -> Generator :
+    '''Decompress an iterable of compressed chunks, yielding decompressed chunks'''
+    if codec == 'zstd' :
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        for chunk in chunks :
+            yield decompressor.decompress(chunk)
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks :
+        while chunk :
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data #a new gzip member starts here (concatenated .gz files)
+            if chunk :
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.flush()
+
+
+class ChunkedReader(io.RawIOBase):
+    '''
+    ChunkedReader - Read-only stream over an iterable of str/bytes chunks, optionally compressing them as they are read.
+    Lets boto3's upload_fileobj stream generated content to S3 (as a multipart upload once it is large) without ever
+    holding more than a part of it in memory.
+        chunks - iterable of str (utf-8 encoded) or bytes
+        codec (opt) - 'gzip' or 'zstd' to compress the stream (default = None, uncompressed)
+        level (opt) - compression level (default = the codec's default)
+    '''
+    def __init__(self, chunks, codec:str = None, level:int = None):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self._eof = False
+        if codec == 'gzip' :
+            self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif codec == 'zstd' :
+            self._compressor = zstandard.ZstdCompressor(**({} if level is None else {'level': level})).compressobj()
+        else :
+            self._compressor = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) < len(b) and not self._eof :
+            chunk = next(self._chunks, None)
+            if chunk is None :
+                self._eof = True
+                if self._compressor is not None :
+                    self._buffer += self._compressor.flush()
+                continue
+            if isinstance(chunk, str) :
+                chunk = chunk.encode()
+            self._buffer += self._compressor.compress(chunk) if self._compressor is not None else chunk
+        count = min(len(b), len(self._buffer))
+        b[:count] = self._buffer[:count]
+        del self._buffer[:count]
+        return count
+
+
+def __content_chunks(content) -> Generator :
+    '''Split str/bytes, a readable file object, or an iterable of str/bytes into chunks of at most COMPRESSION_CHUNK_SIZE'''
+    if isinstance(content, str) :
+        content = content.encode()
+    if isinstance(content, (bytes, bytearray, memoryview)) :
+        view = memoryview(content)
+        for offset in range(0, len(view), COMPRESSION_CHUNK_SIZE) :
+            yield view[offset:offset + COMPRESSION_CHUNK_SIZE]
+    elif hasattr(content, 'read') :
+        yield from iter(lambda: content.read(COMPRESSION_CHUNK_SIZE), content.read(0))
+    else :
+        yield from content
+
+
+class S3ObjectRawIO(io.RawIOBase):
+    '''
+    S3ObjectRawIO - Read-only, seekable raw stream over a single S3 object. Bytes are pulled from an open-ended ranged
+    GET as they are read, so memory use is bounded by the caller's buffer rather than the object size. Seeking drops the
+    current GET and the next read re-opens the object at the new offset.
+        bucket - bucket name
+        key - key of the object to stream
+        size (opt) - object size if already known (saves a HEAD when seeking from the end)
+    '''
+    def __init__(self, bucket:str, key:str, size:int = None):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self._size = size
+        self._pos = 0
+        self._body = None
+
+    @property
+    def size(self) -> int:
+        '''Size of the object in bytes, looked up with a HEAD request the first time it is needed'''
+        if self._size is None:
+            self._size = get_s3_client().head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+        if position != self._pos:
+            self._close_body()
+        self._pos = position
+        return self._pos
+
+    def _open_body(self) -> bool:
+        '''Start a ranged GET at the current position, returns False if the position is at or past the end of the object'''
+        if self._size is not None and self._pos >= self._size:
+            return False
+        try:
+            s3obj = get_s3_client().get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={self._pos}-')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange': #reading at/after the end of the object (or an empty object)
+                return False
+            raise
+        if self._size is None:
+            content_range = s3obj.get('ContentRange')
+            self._size = int(content_range.rsplit('/', 1)[1]) if content_range else self._pos + s3obj['ContentLength']
+        self._body = s3obj['Body']
+        return True
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if len(view) == 0:
+            return 0
+        if self._body is None and not self._open_body():
+            return 0
+        if hasattr(self._body, 'readinto'):
+            amount_read = self._body.readinto(view)
+        else: #older botocore StreamingBody objects only support read()
+            data = self._body.read(len(view))
+            amount_read = len(data)
+            view[:amount_read] = data
+        if amount_read == 0:
+            self._close_body()
+        self._pos += amount_read
+        return amount_read
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class S3StreamReader(io.BufferedReader):
+    '''
+    S3StreamReader - Buffered, file-like reader for an S3 object returned by getS3FileContents(stream=True).
+    Supports everything io.BufferedReader does (read, readinto, readline, seek, iterating over lines, use as a context manager)
+    plus iter_chunks for fixed-size chunk iteration.
+    '''
+    def __init__(self, bucket:str, key:str, size:int = None, buffer_size:int = 8 * 1024 * 1024):
+        super().__init__(S3ObjectRawIO(bucket, key, size), buffer_size=buffer_size)
+
+    @property
+    def size(self) -> int:
+        '''Size of the underlying object in bytes'''
+        return self.raw.size
+
+    def iter_chunks(self, chunk_size:int = 1024 * 1024) -> Generator:
+        '''Yield the rest of the object in chunks of at most chunk_size bytes'''
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class S3MultipartWriter(io.BufferedIOBase):
+    '''
+    S3MultipartWriter - Writable, file-like S3 object, see open_s3_writer. Writes are buffered into partSize parts which
+    are uploaded in the background as a multipart upload while the caller keeps writing, with at most partWorkers + 1
+    parts held in memory. close() uploads the last part and completes the upload (content smaller than one part is sent
+    with a single PutObject). Any error, leaving a with block on an exception, or the writer being garbage collected
+    without close() aborts the upload so no partial object is created.
+        bucket - bucket name
+        key - key to write
+        partSize (opt) - bytes per part, at least 5MB (default = UPLOAD_PART_SIZE)
+        partWorkers (opt) - parts uploaded in parallel (default = 4)
+        extraArgs (opt) - extra CreateMultipartUpload/PutObject arguments, e.g. {'ContentType': 'text/csv'}
+        onComplete (opt) - called once the object has been written
+    '''
+    def __init__(self, bucket:str, key:str, partSize:int = UPLOAD_PART_SIZE, partWorkers:int = 4, extraArgs:dict = None, onComplete = None):
+        if partSize < 5 * 1024 * 1024 :
+            raise ValueError('S3 multipart parts must be at least 5MB')
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.partSize = partSize
+        self.partWorkers = max(partWorkers, 1)
+        self.extraArgs = extraArgs or {}
+        self.bytes_written = 0
+        self.upload_id = None
+        self._onComplete = onComplete
+        self._buffer = bytearray()
+        self._parts = []
+        self._error = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.partWorkers)
+        self._pool = None
+
+    def writable(self):
+        return True
+
+    def write(self, b) -> int:
+        if self.closed :
+            raise ValueError('write to closed S3MultipartWriter')
+        self._raise_error()
+        buffered = len(self._buffer)
+        self._buffer += b
+        written = len(self._buffer) - buffered
+        self.bytes_written += written
+        while len(self._buffer) >= self.partSize :
+            part = bytes(self._buffer[:self.partSize])
+            del self._buffer[:self.partSize]
+            self._upload_part(part)
+        return written
+
+    def _raise_error(self):
+        if self._error is not None :
+            self.abort()
+            raise self._error
+
+    def _upload_part(self, data:bytes):
+        '''Queue a part for upload, blocking while partWorkers parts are already uploading'''
+        if self.upload_id is None :
+            self.upload_id = get_s3_client().create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extraArgs)['UploadId']
+            self._pool = ThreadPool(self.partWorkers)
+        part_number = len(self._parts) + 1
+        self._parts.append(None)
+        self._slots.acquire()
+        self._raise_error()
+        self._pool.apply_async(self._send_part, (part_number, data))
+
+    def _send_part(self, part_number:int, data:bytes):
+        try:
+            response = get_s3_client().upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data)
+            with self._lock:
+                self._parts[part_number - 1] = {'PartNumber': part_number, 'ETag': response['ETag']}
+        except Exception as e:
+            logger.error(f'S3MultipartWriter - uploading part {part_number} of {self.bucket}/{self.key} failed with error {e}')
+            with self._lock:
+                self._error = self._error or e
+        finally:
+            self._slots.release()
+
+    def _wait(self):
+        if self._pool is not None :
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def abort(self):
+        '''Abandon the object, aborting the multipart upload if one was started'''
+        if self.closed :
+            return
+        self._wait()
+        if self.upload_id is not None :
+            try:
+                get_s3_client().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+                logger.info(f'S3MultipartWriter - aborted upload of {self.bucket}/{self.key}')
+            except Exception as e:
+                logger.error(f'S3MultipartWriter - aborting upload of {self.bucket}/{self.key} failed with error {e}')
+        self._buffer = bytearray()
+        super().close()
+
+    def close(self):
+        '''Upload what is left and complete the object'''
+        if self.closed :
+            return
+        try:
+            if self.upload_id is None : #never filled a part, a single PutObject is cheaper
+                get_s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.extraArgs)
+            else :
+                if self._buffer :
+                    self._upload_part(bytes(self._buffer))
+                self._wait()
+                self._raise_error()
+                get_s3_client().complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self._parts})
+        except BaseException:
+            self.abort()
+            raise
+        logger.debug(f'S3MultipartWriter - wrote {self.bytes_written} bytes to {self.bucket}/{self.key} in {max(len(self._parts), 1)} parts')
+        self._buffer = bytearray()
+        super().close()
+        if self._onComplete is not None :
+            self._onComplete()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None :
+            self.abort()
+        else :
+            self.close()
+
+    def __del__(self):
+        #IOBase would close(), completing an object the caller never finished writing
+        if not self.closed and hasattr(self, '_buffer') :
+            self.abort()
+
+
+class S3TextWriter(io.TextIOWrapper):
+    '''Text stream over an S3MultipartWriter, returned by open_s3_writer(mode='w'), which aborts the upload if its with block raises'''
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None :
+            self.buffer.abort()
+        self.close()
+
+    def __del__(self):
+        if not self.closed :
+            self.buffer.abort()
+
+
+def open_s3_writer(s3url:str, mode:str = 'wb', partSize:int = UPLOAD_PART_SIZE, partWorkers:int = 4, encoding:str = 'utf-8', **extraArgs):
+    '''
+    open_s3_writer - Open an S3 object for streaming writes, use as a context manager so the upload is completed (or
+    aborted if the block raises). Memory use stays around (partWorkers + 1) * partSize however much is written.
+        s3url - S3 url of the object to write
+        mode (opt) - 'wb' for a binary S3MultipartWriter, 'w' for a text stream on top of it (default = 'wb')
+        partSize (opt) - bytes per multipart upload part, at least 5MB (default = UPLOAD_PART_SIZE)
+        partWorkers (opt) - parts uploaded in parallel while the caller keeps writing (default = 4)
+        encoding (opt) - text encoding for mode 'w' (default = utf-8)
+        extraArgs (opt) - extra arguments for the upload, e.g. ContentType='text/csv'
+
+    Example:
+        with lp_s3.open_s3_writer('s3://bucket/export.csv', 'w', newline='') as f:
+            csv.writer(f).writerows(cursor)
+    '''
+    bucket = return_s3bucket(s3url).name
+    key = return_s3path(s3url)
+    newline = extraArgs.pop('newline', None)
+    if mode not in ('wb', 'w') :
+        raise ValueError(f"Unsupported mode '{mode}', use 'wb' or 'w'")
+    writer = S3MultipartWriter(bucket, key, partSize, partWorkers, extraArgs, onComplete=lambda: __cache_invalidate(bucket, key))
+    if mode == 'w' :
+        return S3TextWriter(writer, encoding=encoding, newline=newline)
+    return writer
+
+
+def __write_body_at(fd:int, body, offset:int, lock:threading.Lock):
+    '''Stream an S3 response body into an open file descriptor starting at offset'''
+    for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+        view = memoryview(chunk)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, view, offset)
+            else: #Windows has no pwrite, so serialize the seek+write pairs across part workers
+                with lock:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, view)
+            offset += written
+            view = view[written:]
+
+
+def download_s3_object(bucket:str, key:str, filepath, partSize:int = DOWNLOAD_PART_SIZE, partWorkers:int = DOWNLOAD_PART_WORKERS) -> dict:
+    '''
+    download_s3_object - Download a single S3 object to a local file, splitting large objects into byte ranges that are
+    fetched in parallel and written at their offset in a preallocated file. The first range request doubles as the
+    metadata lookup, so no separate HEAD or second GET is made.
+        bucket - bucket name
+        key - key of the object to download
+        filepath - local file path to write to; data is written to <filepath>.part and renamed once complete
+        partSize (opt) - size in bytes of each ranged GET (default = DOWNLOAD_PART_SIZE)
+        partWorkers (opt) - number of threads fetching ranges for this object, set to 1 to fetch ranges serially (default = DOWNLOAD_PART_WORKERS)
+
+    Return - dict with the object's ContentLength, LastModified and ETag
+    '''
+    filepath = Path(filepath)
+    partpath = filepath.with_name(filepath.name + '.part')
+    try:
+        s3obj = get_s3_client().get_object(Bucket=bucket, Key=key, Range=f'bytes=0-{partSize - 1}')
+        size = int(s3obj['ContentRange'].rsplit('/', 1)[1])
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidRange':
+            raise
+        s3obj = get_s3_client().get_object(Bucket=bucket, Key=key) #Zero byte objects can't satisfy a range request
+        size = s3obj['ContentLength']
+    etag = s3obj['ETag']
+
+    lock = threading.Lock()
+    fd = os.open(partpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    try:
+        os.ftruncate(fd, size) #preallocate so every part can be written at its offset as soon as it arrives
+        __write_body_at(fd, s3obj['Body'], 0, lock)
+
+        def get_part(start):
+            end = min(start + partSize, size) - 1
+            part = get_s3_client().get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag) #fail rather than mix two versions of the object
+            __write_body_at(fd, part['Body'], start, lock)
+
+        part_starts = range(partSize, size, partSize)
+        if partWorkers > 1 and len(part_starts) > 1 :
+            with ThreadPool(min(partWorkers, len(part_starts))) as pool:
+                pool.map(get_part, part_starts)
+        else :
+            for start in part_starts:
+                get_part(start)
+    except BaseException:
+        os.close(fd)
+        partpath.unlink(missing_ok=True)
+        raise
+    os.close(fd)
+    os.replace(partpath, filepath)
+    return {'ContentLength': size, 'LastModified': s3obj['LastModified'], 'ETag': etag}
+
+
+def __getAS3File(bucket, key, downloadfolder = '.', delete = False, fileLedger = None, contents = False, partSize = DOWNLOAD_PART_SIZE, partWorkers = DOWNLOAD_PART_WORKERS, raiseErrors = False, deleter = None, decompress = False) :
     '''
     #TODO - Deal with the fileLedger better for return of object contents, so it's not just the localfolder
+        raiseErrors (opt) - re-raise download errors after logging them, used by BoundedTaskPool to collect failures
+        deleter (opt) - BatchDeleter to queue the key on when delete is True, instead of deleting it immediately
+        decompress (opt) - with contents, decompress the returned bytes as described in getS3FileContents (default = False)
     '''
     try:
         logger.info("Function getAS3Files - Trying to download " + bucket.name + "/" + key)
-        # s3c.download_file(bucket.name, key, downloadfolder + '/' + key.split('/')[-1])
-        # logger.info("Function getAS3Files - " + bucket.name + "/" + key + " downloaded successfully")
 
-        s3obj = s3c.get_object(
-                Bucket=bucket.name,
-                Key=key
-        )
+        if contents :
+            s3obj = get_s3_client().get_object(
+                    Bucket=bucket.name,
+                    Key=key
+            )
+        else :
+            logger.debug(f"Function getAS3File - {bucket.name} | {key} | {downloadfolder}'/'{key.split('/')[-1]}")
+            s3obj = download_s3_object(bucket.name, key, downloadfolder + '/' + key.split('/')[-1], partSize=partSize, partWorkers=partWorkers)
+            logger.info("Function getAS3Files - " + bucket.name + "/" + key + " downloaded successfully")
 
         if fileLedger:
+            mtime = (s3obj['LastModified'].replace(tzinfo=None) - datetime.datetime.utcfromtimestamp(0)).total_seconds()
+            if not contents : #stamp the local copy with the S3 modified time so the ledger mtime matches the file on disk
+                os.utime(downloadfolder + '/' + key.split('/')[-1], (mtime, mtime))
             lp_logging.writeToFileLedger(
                     return_s3filename(key),
                     's3://' + bucket.name + '/' + key,
                     Path(downloadfolder).resolve(), #Get the full path, not just the relative one passed in
-                    (s3obj['LastModified'].replace(tzinfo=None) - datetime.datetime.utcfromtimestamp(0)).total_seconds(),
+                    mtime,
                     s3obj['ContentLength'],
-                    fileledgerpath=fileLedger
+                    fileledgerpath=fileLedger,
+                    etag=s3obj['ETag']
                 )
 
-        logger.debug(f"Function getAS3File - {bucket.name} | {key} | {downloadfolder}'/'{key.split('/')[-1]}")
-        if not contents :
-            s3c.download_file(bucket.name, key, downloadfolder + '/' + key.split('/')[-1])
-            logger.info("Function getAS3Files - " + bucket.name + "/" + key + " downloaded successfully")
-
-        if delete :
+        if delete and deleter is not None :
+            deleter.add(bucket.name, key)
+        elif delete :
             try:
-                s3c.delete_object(
+                get_s3_client().delete_object(
                     Bucket=bucket.name,
                     Key=key
                 )
+                __cache_invalidate(bucket.name, key)
                 logger.info("Function getAS3Files - " + bucket.name + "/" + key + " deleted successfully")
             except Exception as e:
                 logger.error("Function getAS3Files - Deleting s3 object " + bucket.name + "/" + key + " failed with error " + str(e))
                 traceback.print_exc()
 
-        if contents :
-            return s3obj['Body'].read() #This might be problematic long-term, possibly just return the body and let the user stream it?
+        if contents : #Use getS3FileContents(stream=True) to avoid holding large objects in memory
+            codec = __read_codec(key, s3obj.get('ContentEncoding'), decompress)
+            if codec is None :
+                return s3obj['Body'].read()
+            return b''.join(__decompress_chunks(s3obj['Body'].iter_chunks(COMPRESSION_CHUNK_SIZE), codec))
     except Exception as e:
+        if raiseErrors and is_throttle_error(e) : #the adaptive pool retries it, don't log a failure yet
+            logger.warning(f"Function getAS3Files - download of s3 object {bucket.name}/{key} throttled: {e}")
+            raise
         logger.error("Function getAS3Files - downloaded s3 object " + bucket.name + "/" + key + " failed with error " + str(e))
         traceback.print_exc()
+        if raiseErrors :
+            raise
 
 
-def getS3Files(s3url, downloadfolder = '.', archive = False, delete = False, suffix = '', fileLedger = None, poolWorkers = 100, doFDWCallback = False) :
+class TransferCheckpoint:
+    '''
+    TransferCheckpoint - resume state of one bulk transfer job, kept in an lp_logging.TransferJournal.
+    Listing pages are tracked in order, and once every key of the oldest pages has been transferred the journal's
+    continuation token moves past them. Keys finished ahead of the token are journaled individually, so a rerun lists
+    from the token and skips them. Keys that fail stay outstanding, so their page is listed again on the next run.
+        journal - path of the SQLite TransferJournal
+        job - name identifying the job, e.g. the function and its source and destination
+        deleter (opt) - BatchDeleter the job queues its source deletes on, flushed before the token moves past their
+                    keys so a crash can't strand sources that were transferred but not yet deleted (default = None)
+    '''
+    def __init__(self, journal, job:str, deleter:BatchDeleter = None):
+        self.journal = lp_logging.get_transfer_journal(journal)
+        self.job = job
+        self.deleter = deleter
+        self.token = self.journal.get_token(job)
+        self.completed = self.journal.completed_keys(job)
+        self._pages = deque() #[NextContinuationToken, keys outstanding, keys listed] for pages not yet checkpointed
+        self._lock = threading.Lock()
+        if self.token or self.completed :
+            logger.info(f'Resuming {job} - {len(self.completed)} keys already transferred past the last checkpoint')
+
+    def pages(self, bucket:str, prefix:str, s3delimiter:str) -> Generator :
+        '''Yield (objects, NextContinuationToken) for each list_objects_v2 page, starting from the checkpoint'''
+        kwargs = {'Bucket':bucket, 'Prefix':prefix, 'Delimiter':s3delimiter}
+        token = self.token
+        while True :
+            if token :
+                kwargs['ContinuationToken'] = token
+            page = get_s3_client().list_objects_v2(**kwargs)
+            token = page.get('NextContinuationToken')
+            yield page.get('Contents', []), token
+            if not page.get('IsTruncated') :
+                return
+
+    def add_page(self, keys:list, nextToken:str, outstanding:list):
+        '''Track a listed page, keys being all its keys and outstanding those about to be transferred'''
+        with self._lock :
+            self._pages.append([nextToken, set(outstanding), keys])
+            self._advance()
+
+    def run(self, key:str, func, *args, **kwargs):
+        '''Run func(*args, **kwargs) to transfer key, journaling key once it succeeds'''
+        result = func(*args, **kwargs)
+        with self._lock :
+            self.journal.record_key(self.job, key)
+            for page in self._pages :
+                if key in page[1] :
+                    page[1].discard(key)
+                    break
+            self._advance()
+        return result
+
+    def _advance(self):
+        '''Checkpoint past the leading pages whose keys have all been transferred (and deleted, with a deleter)'''
+        if self.deleter is not None and self._pages and not self._pages[0][1] and self._pages[0][0] :
+            self.deleter.flush()
+            failed = {error.key for error in self.deleter.errors}
+            if failed : #a key that couldn't be deleted keeps its page listed on the next run
+                for page in self._pages :
+                    page[1].update(failed.intersection(page[2]))
+        passed = []
+        token = None
+        while self._pages and not self._pages[0][1] and self._pages[0][0] :
+            page = self._pages.popleft()
+            token = page[0]
+            passed.extend(page[2])
+        if token :
+            self.journal.checkpoint(self.job, token, passed)
+
+    def finish(self):
+        '''Forget the job, every key has been transferred'''
+        self.journal.finish(self.job)
+
+
+def __journaled_objects(checkpoint:TransferCheckpoint, s3url:str, suffix:str = '', s3delimiter:str = '/') -> Generator :
+    '''Yield (obj, finished) for the keys under s3url from the checkpoint on, finished being True if an earlier run transferred the key'''
+    for contents, nextToken in checkpoint.pages(return_s3bucket(s3url).name, return_s3path(s3url), s3delimiter) :
+        objs = [obj for obj in contents if not obj['Key'].endswith('/') and obj['Key'].endswith(suffix)]
+        checkpoint.add_page([obj['Key'] for obj in contents], nextToken, [obj['Key'] for obj in objs if obj['Key'] not in checkpoint.completed])
+        for obj in objs :
+            yield obj, obj['Key'] in checkpoint.completed
+
+
+def __adaptive_concurrency(adaptive, poolWorkers:int) -> AdaptiveConcurrency:
+    '''Turn the adaptive argument of a bulk function into the AdaptiveConcurrency (or None) its BoundedTaskPool uses'''
+    if isinstance(adaptive, AdaptiveConcurrency) :
+        return adaptive
+    return AdaptiveConcurrency(poolWorkers) if adaptive and poolWorkers > 1 else None
+
+
+def __log_metrics(caller:str, metrics:TransferMetrics):
+    '''Log the end of run summary of a bulk transfer'''
+    summary = metrics.summary()
+    logger.info(f"Function {caller} - {summary['files_done']} files, {summary['bytes_done']} bytes in {summary['seconds']:.2f}s at {summary['MBps']:.2f} MB/s, "
+                f"{summary['files_failed']} failed, p50 {summary['p50_latency'] or 0:.3f}s, p99 {summary['p99_latency'] or 0:.3f}s")
+
+
+def __flush_deleter(deleter:BatchDeleter, results:TaskResults, caller:str):
+    '''Delete the keys still queued on deleter and record any per-key failures on results'''
+    for error in deleter.flush():
+        logger.error(f'Function {caller} - {error}')
+        results.errors.append(((error.bucket, error.key), error))
+    logger.info(f'Function {caller} - deleted {deleter.deleted} source objects')
+
+
+def getS3Files(s3url, downloadfolder = '.', archive = False, delete = False, suffix = '', fileLedger = None, poolWorkers = 100, doFDWCallback = False, partSize = DOWNLOAD_PART_SIZE, partWorkers = DOWNLOAD_PART_WORKERS, maxPending = None, metrics = None, adaptive = False, journal = None) :
     '''Retrieve files from an S3 bucket. Specify an individual file, or a directory to download all files. Will not recurse into subdirectories.
         s3url - path to file(s) on S3 to retrieve
         downloadfolder (opt) - Local folder to download files to (default = current directory)
         suffix (opt) - Allow passing a suffix to filter files downloaded
         archive (opt) - True/False - move the file to an archive subdirectory once successfully downloaded (default = False)
         delete (opt) - True/False - delete the file from S3 once successfully downloaded (default = False)
-        fileLedger (opt) - designed for s3same, captures details of files in a list of dictionaries
+        fileLedger (opt) - path to a SQLite file ledger (see lp_logging.FileLedger) to record each downloaded file in
+        partSize (opt) - objects larger than this many bytes are downloaded as parallel byte ranges of this size (default = DOWNLOAD_PART_SIZE)
+        partWorkers (opt) - number of threads fetching byte ranges of each large object (default = DOWNLOAD_PART_WORKERS)
+        maxPending (opt) - maximum downloads queued at once before listing pauses (default = 2 * poolWorkers)
+        metrics (opt) - TransferMetrics to report progress on, e.g. TransferMetrics(progressCallback=print)
+        adaptive (opt) - True/False or an AdaptiveConcurrency - start below poolWorkers downloads in flight, back off when S3
+                    throttles and retry throttled keys (default = False)
+        journal (opt) - path to a SQLite TransferJournal (see lp_logging), records downloaded keys and the listing position so
+                    rerunning an interrupted or failed download with the same arguments resumes where it stopped (default = None)
+
+    Return - TaskResults (True if files were downloaded without errors), or False if the arguments are invalid
     '''
     logger.info(f'Downloading files from {s3url} to {downloadfolder}')
     logger.debug(f'Archive: {archive}|delete: {delete}|fileLedger: {fileLedger}|poolWorkers: {poolWorkers}')
@@ -158,66 +1353,98 @@ def getS3Files(s3url, downloadfolder = '.', archive = False, delete = False, suf
         traceback.print_exc()
         return False
 
-    bucket = return_s3bucket(s3url)
-    filecount = 0
-
-    if poolWorkers > 1 : #if set to 1, skip multiprocessing
-        pool = ThreadPool(poolWorkers)
-
     if not Path(downloadfolder).is_dir() :
         logger.error(f"Local path '{downloadfolder}' does not exist, unable to download files")
         traceback.print_exc()
         return False
 
+    bucket = return_s3bucket(s3url)
+    deleter = BatchDeleter() if delete else None
+    checkpoint = TransferCheckpoint(journal, f'getS3Files {s3url} -> {Path(downloadfolder).resolve()} suffix={suffix}', deleter) if journal else None
+    if checkpoint is not None :
+        listing = __journaled_objects(checkpoint, s3url, suffix)
+    else : #TODO -- support passing in s3delimeter to support recursion in this function
+        listing = ((obj, False) for obj in listMatchingS3Keys(s3url, suffix = suffix, returnObj = True))
+    listed_all = False
+    pool = BoundedTaskPool(poolWorkers, maxPending, metrics, __adaptive_concurrency(adaptive, poolWorkers)) #if poolWorkers is 1, downloads run serially
     try :
-        for key in listMatchingS3Keys(s3url, suffix = suffix) : #TODO -- support passing in s3delimeter to support recursion in this function
+        for obj, finished in listing :
+            key = obj['Key']
             if key.endswith('/') : #we'll get the folder in the results, which we don't want to download
                 continue
-
-            try :
-                if poolWorkers > 1 :
-                    pool.apply_async(__getAS3File, (bucket, key,), {'downloadfolder':downloadfolder, 'delete':delete, 'fileLedger':fileLedger})
-                else :
-                    __getAS3File(bucket, key, downloadfolder=downloadfolder, delete=delete, fileLedger=fileLedger)
-
-                filecount += 1
-            except KeyboardInterrupt :
-                # Ctrl-C pressed
-                logger.error("CTRL-C pressed ")
-                if poolWorkers > 1 :
-                    pool.close()
-                    pool.join()  # Wait for all operations to finish
-                return False
-            except Exception as e:
-                logger.error("Downloaded s3 object " + bucket.name + "/" + key + " failed with error " + str(e))
-                traceback.print_exc()
+            if finished : #downloaded by an earlier run, it may not have lived to delete it
+                if deleter is not None :
+                    deleter.add(bucket.name, key)
                 continue
+            task = (checkpoint.run, key, __getAS3File) if checkpoint is not None else (__getAS3File,)
+            pool.submit(*task, bucket, key, downloadfolder=downloadfolder, delete=delete, fileLedger=fileLedger, partSize=partSize, partWorkers=partWorkers, raiseErrors=True, deleter=deleter, taskBytes=obj['Size'])
+        listed_all = True
+    except KeyboardInterrupt :
+        # Ctrl-C pressed
+        logger.error("CTRL-C pressed, cancelling downloads not yet started")
+        pool.cancel()
+    except Exception : #listing failed, don't start the queued downloads but finish and delete the ones running
+        pool.cancel()
+        raise
     finally :
-        if poolWorkers > 1 :
-            pool.close()
-            pool.join()  # Wait for all operations to finish
-    if poolWorkers > 1 :
-        if filecount > 0 :
-            logger.info("Downloaded " + str(filecount) +" files from " + s3url + " to " + downloadfolder)
+        if pool.taskresults.submitted > 0 :
             logger.info('Waiting for all downloads to complete')
-        pool.close()
-        pool.join()  # Wait for all operations to finish
-
-    if filecount > 0 :
-        return True
-    return False
-
-
-def getS3FileContents(s3url, delete = False, fileLedger = None):
+        results = pool.join()  # Wait for all operations to finish
+        if deleter is not None :
+            __flush_deleter(deleter, results, 'getS3Files')
+    if checkpoint is not None and listed_all and not results.errors and not results.cancelled :
+        checkpoint.finish()
+    if results.submitted > 0 :
+        logger.info(f"Downloaded {results.submitted - len(results.errors)} of {results.submitted} files from {s3url} to {downloadfolder}")
+        __log_metrics('getS3Files', results.metrics)
+    return results
+
+
+def getS3FileContents(s3url, delete = False, fileLedger = None, stream = False, buffer_size = 8 * 1024 * 1024, decompress = None):
     '''
     Return the contents of an S3 file, for use in either a file-like object or as the text of a file
+        stream (opt) - True/False - return a seekable S3StreamReader instead of reading the whole object into memory.
+                    The reader supports read/readinto/readline, line iteration and iter_chunks(). (default = False)
+        buffer_size (opt) - read buffer size in bytes used when streaming (default = 8MB)
+        decompress (opt) - None/True/False - None decompresses objects with a gzip or zstd Content-Encoding (as written by
+                    write_file_to_S3 with compression), True also decompresses keys ending .gz/.zst, False returns the raw bytes.
+                    A decompressed stream is a read-only file object decoding as it reads, rather than an S3StreamReader. (default = None)
     '''
     bucket = return_s3bucket(s3url)
     key = return_s3path(s3url)
-    return __getAS3File(bucket, key, contents = True, delete=delete, fileLedger=fileLedger)
+    if stream :
+        if delete :
+            logger.error(f"Function getS3FileContents - Cannot delete {s3url} while streaming it, delete the key once the stream has been read")
+            return None
+        if decompress is False :
+            return S3StreamReader(bucket.name, key, buffer_size=buffer_size)
+        head = get_s3_client().head_object(Bucket=bucket.name, Key=key)
+        reader = S3StreamReader(bucket.name, key, size=head['ContentLength'], buffer_size=buffer_size)
+        codec = __read_codec(key, head.get('ContentEncoding'), decompress)
+        if codec == 'gzip' :
+            return gzip.GzipFile(fileobj=reader, mode='rb')
+        if codec == 'zstd' :
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True), buffer_size=COMPRESSION_CHUNK_SIZE)
+        return reader
+    return __getAS3File(bucket, key, contents = True, delete=delete, fileLedger=fileLedger, decompress=decompress)
+
+
+def upload_transfer_config(partSize:int = UPLOAD_PART_SIZE, partWorkers:int = UPLOAD_PART_WORKERS, multipartThreshold:int = UPLOAD_MULTIPART_THRESHOLD) -> boto3.s3.transfer.TransferConfig:
+    '''
+    upload_transfer_config - Build the boto3 TransferConfig used for uploads
+        partSize (opt) - size in bytes of each multipart upload part (S3 minimum is 5MB)
+        partWorkers (opt) - number of parts of a single file uploaded in parallel, set to 1 to upload parts serially
+        multipartThreshold (opt) - files of at least this many bytes use multipart upload, smaller files use a single PUT
+    '''
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=multipartThreshold,
+        multipart_chunksize=partSize,
+        max_concurrency=partWorkers,
+        use_threads=partWorkers > 1
+    )
 
 
-def sendAFileToS3(filepath, s3url, delete = False, bucket=''):
+def sendAFileToS3(filepath, s3url, delete = False, bucket='', fileLedger = None, transferConfig = None, raiseErrors = False, keyName = None):
     '''
     sendAFileToS3 - mostly designed to be called by sendFilesToS3 to enabled multiprocessing,
     but can also be called for individual files to aid efficiency when parallelism is unneeded
@@ -226,22 +1453,44 @@ def sendAFileToS3(filepath, s3url, delete = False, bucket=''):
         delete (opt) - True/False - delete the local file once successfully uploaded
         bucket (opt) - if a bucket object exists, pass it in to improve efficiency
         fileLedger (opt) - capture details of files moved in a fileledger, pass in path to turn on
+        transferConfig (opt) - TransferConfig from upload_transfer_config() controlling multipart part size/concurrency (default = upload_transfer_config())
+        raiseErrors (opt) - re-raise upload errors after logging them, used by BoundedTaskPool to collect failures
+        keyName (opt) - key to upload to under s3url, e.g. the file's path relative to a walked folder (default = the file name)
+
+    Return - number of bytes uploaded, None if the file was not uploaded
     '''
 
     filepath = Path(filepath)
     if filepath.is_dir() : #can't upload a directory, so nothing to do
-        return
+        return None
 
     if bucket == '' :
         bucket = return_s3bucket(s3url)
+    if transferConfig is None :
+        transferConfig = upload_transfer_config()
 
     s3folderpath = return_s3path(s3url)
+    key = s3folderpath + (keyName or filepath.name)
     try :
-        s3c.upload_file(str(filepath), bucket.name, s3folderpath + filepath.name)
+        filestat = filepath.stat()
+        filesize = filestat.st_size
+        start_time = time.monotonic()
+        get_s3_client().upload_file(str(filepath), bucket.name, key, Config=transferConfig)
+        __cache_invalidate(bucket.name, key)
+        elapsed = time.monotonic() - start_time
         logger.info("Function sendAFileToS3 - file " + str(filepath) + " uploaded successfully to " + s3url)
+        if fileLedger :
+            lp_logging.writeToFileLedger(filepath.name, 's3://' + bucket.name + '/' + key, filepath.parent.resolve(), filestat.st_mtime, filesize, fileledgerpath=fileLedger)
+        logger.debug(f"Function sendAFileToS3 - {filesize} bytes in {elapsed:.2f}s ({filesize / 1048576 / max(elapsed, 1e-6):.2f} MB/s)")
     except Exception as e :
+        if raiseErrors and is_throttle_error(e) : #the adaptive pool retries it, don't log a failure yet
+            logger.warning(f"uploading file {filepath} to s3 location {bucket.name}/{s3folderpath} throttled: {e}")
+            raise
         logger.error("uploading file " + str(filepath) + " to s3 location " + bucket.name + "/" + s3folderpath + " failed with error " + str(e))
         traceback.print_exc()
+        if raiseErrors :
+            raise
+        return None #don't delete a file that didn't make it to S3
 
     if delete :
         try:
@@ -250,9 +1499,65 @@ def sendAFileToS3(filepath, s3url, delete = False, bucket=''):
         except Exception as e:
             logger.error("Function sendAFileToS3 - Deleting file " + str(filepath) + " failed with error " + str(e))
             traceback.print_exc()
+    return filesize
 
 
-def sendFilesToS3(filepath, s3url, delete = False, poolWorkers = 100, fileLedger = None) :
+def compute_etag(filepath, partSize:int = None) -> str:
+    '''
+    compute_etag - the ETag S3 gives a local file once uploaded (unencrypted or SSE-S3)
+        filepath - local file to hash
+        partSize (opt) - part size of a multipart upload, the ETag is then the MD5 of the part MD5s followed by '-<parts>' (default = single part upload, the file's MD5)
+    '''
+    chunkSize = 1024 * 1024
+    with open(filepath, 'rb') as f :
+        if partSize is None :
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(chunkSize), b'') :
+                md5.update(chunk)
+            return md5.hexdigest()
+        part_digests = []
+        while True :
+            md5 = hashlib.md5()
+            remaining = partSize
+            while remaining > 0 :
+                chunk = f.read(min(chunkSize, remaining))
+                if not chunk :
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if remaining == partSize and part_digests : #nothing left for another part
+                break
+            part_digests.append(md5.digest())
+            if remaining > 0 :
+                break
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + f'-{len(part_digests)}'
+
+
+def __etag_part_sizes(size:int, etag:str, partSize:int) -> list:
+    '''Part sizes that could have produced a multipart ETag of etag for an object of size bytes, most likely first'''
+    parts = int(etag.rsplit('-', 1)[1])
+    mb = 1024 * 1024
+    exact = -(-size // parts)
+    candidates = [partSize, 8 * mb, 16 * mb, 5 * mb, 64 * mb, 100 * mb, -(-exact // mb) * mb, exact]
+    return [candidate for i, candidate in enumerate(candidates) if candidate and candidate not in candidates[:i] and -(-size // candidate) == parts]
+
+
+def __file_matches_etag(filepath:str, etag:str, partSizes:list) -> bool:
+    '''Run in a worker process by sendFilesToS3(skipUnchanged=True) - True if the local file hashes to the remote ETag'''
+    if '-' not in etag :
+        return compute_etag(filepath) == etag
+    return any(compute_etag(filepath, partSize) == etag for partSize in partSizes)
+
+
+def __upload_if_changed(matches, filepath, *uploadArgs):
+    '''Upload filepath with sendAFileToS3 unless the hashing future matches says the remote copy is identical'''
+    if matches.result() :
+        logger.info(f"Function sendFilesToS3 - {filepath} is unchanged in S3, skipping")
+        return TASK_SKIPPED
+    return sendAFileToS3(filepath, *uploadArgs)
+
+
+def sendFilesToS3(filepath, s3url, delete = False, poolWorkers = 100, fileLedger = None, partSize = UPLOAD_PART_SIZE, partWorkers = UPLOAD_PART_WORKERS, multipartThreshold = UPLOAD_MULTIPART_THRESHOLD, maxPending = None, metrics = None, adaptive = False, recursive = True, include = None, exclude = None, skipUnchanged = False, hashWorkers = None) -> TaskResults:
     '''
     sendFilesToS3 - send a single file, file glob, or directory to and S3 location
         filepath - local filepath of file(s) to send to S3
@@ -260,43 +1565,188 @@ def sendFilesToS3(filepath, s3url, delete = False, poolWorkers = 100, fileLedger
         delete (opt) - True/False - delete the local file once successfully uploaded
         archive (opt) - True/False - move the file into an archived directory once successfully uploaded
         poolWorkers (opt) - 1 - Number of pool workers to use, set to 1 to disable multithreading by default
-        fileLedger (opt) - designed for s3same, captures details of files in a json fileledger
+        fileLedger (opt) - path to a SQLite file ledger (see lp_logging.FileLedger) to record each uploaded file in
+        partSize (opt) - multipart upload part size in bytes for large files (default = UPLOAD_PART_SIZE)
+        partWorkers (opt) - parts of each large file uploaded in parallel, on top of the poolWorkers files in flight (default = UPLOAD_PART_WORKERS)
+        multipartThreshold (opt) - files of at least this many bytes use multipart upload (default = UPLOAD_MULTIPART_THRESHOLD)
+        maxPending (opt) - maximum uploads queued at once before the directory walk pauses (default = 2 * poolWorkers)
+        metrics (opt) - TransferMetrics to report progress on, e.g. TransferMetrics(progressCallback=print)
+        adaptive (opt) - True/False or an AdaptiveConcurrency - start below poolWorkers uploads in flight, back off when S3
+                    throttles and retry throttled files (default = False)
+        recursive (opt) - True/False - upload subdirectories too, keeping their paths relative to filepath in the keys (default = True)
+        include (opt) - list of fnmatch patterns, only upload files whose relative path or name matches one (see lp_general.listdir_path_v2)
+        exclude (opt) - list of fnmatch patterns, skip files and directories whose relative path or name matches one
+        skipUnchanged (opt) - True/False - don't upload files whose size and MD5/multipart ETag match the object already in S3.
+                    Files the same size as their object are hashed in a process pool, other files upload straight away (default = False)
+        hashWorkers (opt) - processes hashing files when skipUnchanged is set (default = number of CPUs)
+
+    Return - TaskResults (True if files were uploaded without errors): results holds the bytes uploaded per file, skipped
+            the files left alone by skipUnchanged, and metrics.summary() the bytes, seconds, MBps and latency percentiles achieved
     '''
-    #If we're archiving, validate the archived directory exists before proceeding
-
-    if len(list(lp_general.listdir_path_v2(filepath))) == 0 :
-        logger.warning("Function sendFilesToS3 sending files in " + filepath + " to " + s3url + " - No files in " + filepath)
-        return
-
-    logger.info("Function sendFilesToS3 - uploading files from " + filepath + " to " + s3url)
+    logger.info("Function sendFilesToS3 - uploading files from " + str(filepath) + " to " + s3url)
     bucket = return_s3bucket(s3url)
-    filecount = 0
-    if poolWorkers > 1 : #if set to 1, skip multiprocessing
-        pool = ThreadPool(poolWorkers)
+    transferConfig = upload_transfer_config(partSize, partWorkers, multipartThreshold)
 
+    remote = {}
+    hashers = None
+    if skipUnchanged :
+        s3folderpath = return_s3path(s3url)
+        remote = {obj['Key'][len(s3folderpath):]: (obj['Size'], obj['ETag'].strip('"')) for obj in listMatchingS3Keys(s3url, returnObj=True, s3delimiter='' if recursive else '/')}
+        hashers = ProcessPoolExecutor(hashWorkers) #hashing is CPU bound, so it runs outside the GIL
+
+    pool = BoundedTaskPool(poolWorkers, maxPending, metrics, __adaptive_concurrency(adaptive, poolWorkers)) #if poolWorkers is 1, uploads run serially
     try :
-        for f in lp_general.listdir_path_v2(filepath) :
-            #we can only send files, so make sure this isn't a directory
-            if f.is_dir() :
-                continue
-            if poolWorkers > 1 :
-                pool.apply_async(sendAFileToS3, (f, s3url, delete, bucket, fileLedger,))
+        #uploads start as soon as the walk finds the first file, the walk pauses while maxPending uploads are outstanding
+        for f in lp_general.listdir_path_v2(filepath, recursive=recursive, include=include, exclude=exclude) :
+            size, etag = remote.get(f.relpath, (None, None))
+            if size == f.size : #same size as the object in S3, let the hash decide
+                matches = hashers.submit(__file_matches_etag, str(f.path), etag, __etag_part_sizes(f.size, etag, partSize) if '-' in etag else [])
+                pool.submit(__upload_if_changed, matches, f.path, s3url, delete, bucket, fileLedger, transferConfig, True, f.relpath, taskBytes=f.size)
             else :
-                sendAFileToS3(f, s3url, delete, bucket, fileLedger)
-            filecount += 1
+                pool.submit(sendAFileToS3, f.path, s3url, delete, bucket, fileLedger, transferConfig, True, f.relpath, taskBytes=f.size)
     except KeyboardInterrupt :
         # Ctrl-C pressed
-        pool.close()
         logger.info("Cancelling upload...")
-        pool.join()  # Wait for all operations to finish
-    if poolWorkers > 1 :
-        if filecount > 0:
+        pool.cancel()
+    except Exception : #the walk failed, don't start the queued uploads but let the running ones finish
+        pool.cancel()
+        raise
+    finally :
+        if hashers is not None :
+            hashers.shutdown(wait=False) #hashes already queued still complete for the uploads waiting on them
+        if pool.taskresults.submitted > 0 :
             logger.info('Function sendFilesToS3 waiting for all uploads to complete')
-        pool.close()
-        pool.join()  # Wait for all operations to finish
+        results = pool.join()  # Wait for all operations to finish
+    if results.submitted == 0 :
+        logger.warning("Function sendFilesToS3 sending files in " + str(filepath) + " to " + s3url + " - No files in " + str(filepath))
+        return results
+
+    logger.info(f"Function sendFilesToS3 - uploaded {len(results.results)} of {results.submitted} files, {results.skipped} unchanged files skipped")
+    __log_metrics('sendFilesToS3', results.metrics)
+    return results
 
 
-def copyFileInS3(s3urlfrom, s3urlto, delete=False, rename = False) :
+def sync(source:str, destination:str, fileLedger, suffix = '', poolWorkers = 100, maxPending = None) -> TaskResults:
+    '''
+    sync - Incrementally copy files between S3 and a local folder, in the direction given by which argument is an s3:// url.
+    Only files that are new or changed since they were last recorded in the file ledger are transferred:
+        S3 -> local: the key's ETag and size match the ledger and the local file still exists with that size
+        local -> S3: the local file's size and mtime match the ledger
+        source - s3:// url of the keys to download, or the local file/directory/glob to upload (directories are walked
+                recursively and uploaded under their relative paths, as sendFilesToS3 does)
+        destination - local folder to download to, or s3:// url to upload to (hint: this should end in '/')
+        fileLedger - path to the SQLite file ledger, created on first use
+        suffix (opt) - only sync keys ending with this suffix (S3 -> local only)
+        poolWorkers (opt) - number of files transferred in parallel (default = 100)
+        maxPending (opt) - maximum transfers queued at once before listing pauses (default = 2 * poolWorkers)
+
+    Returns - TaskResults of the files transferred
+    '''
+    ledger = lp_logging.get_file_ledger(fileLedger)
+    download = source[0:5].lower() == 's3://'
+    if download == (destination[0:5].lower() == 's3://') :
+        logger.error(f'Function sync - exactly one of {source} and {destination} needs to be an s3:// url')
+        return TaskResults()
+    if download and not Path(destination).is_dir() :
+        logger.error(f"Function sync - Local path '{destination}' does not exist, unable to download files")
+        return TaskResults()
+
+    skipped = 0
+    pool = BoundedTaskPool(poolWorkers, maxPending)
+    try :
+        if download :
+            bucket = return_s3bucket(source)
+            for obj in listMatchingS3Keys(source, suffix = suffix, returnObj = True) :
+                entry = ledger.get('s3://' + bucket.name + '/' + obj['Key'])
+                localfile = Path(destination) / obj['Key'].split('/')[-1]
+                if entry and entry['etag'] == obj['ETag'] and entry['size'] == obj['Size'] and localfile.is_file() and localfile.stat().st_size == obj['Size'] :
+                    skipped += 1
+                    continue
+                pool.submit(__getAS3File, bucket, obj['Key'], downloadfolder=destination, fileLedger=fileLedger, raiseErrors=True, taskBytes=obj['Size'])
+        else :
+            bucket = return_s3bucket(destination)
+            s3folderpath = return_s3path(destination)
+            transferConfig = upload_transfer_config()
+            for f in lp_general.listdir_path_v2(source) : #same walk and key names as sendFilesToS3
+                entry = ledger.get('s3://' + bucket.name + '/' + s3folderpath + f.relpath)
+                if entry and entry['size'] == f.size and entry['mtime'] == f.mtime :
+                    skipped += 1
+                    continue
+                pool.submit(sendAFileToS3, f.path, destination, False, bucket, fileLedger, transferConfig, True, f.relpath, taskBytes=f.size)
+    except KeyboardInterrupt :
+        # Ctrl-C pressed
+        logger.info("Cancelling sync...")
+        pool.cancel()
+    except Exception : #listing failed, don't start the queued transfers but let the running ones finish
+        pool.cancel()
+        raise
+    finally :
+        results = pool.join()
+    logger.info(f'Function sync - {source} to {destination}: transferred {results.submitted - len(results.errors)}, unchanged {skipped}, failed {len(results.errors)}')
+    return results
+
+
+def copy_s3_object(bucket_from:str, key_from:str, bucket_to:str, key_to:str, size:int = None, partSize:int = COPY_PART_SIZE, partWorkers:int = COPY_PART_WORKERS, multipartThreshold:int = COPY_MULTIPART_THRESHOLD):
+    '''
+    copy_s3_object - Server side copy of one object using bucket/key names directly (no URL parsing). Objects smaller
+    than multipartThreshold are copied with a single CopyObject; larger ones with parallel UploadPartCopy requests.
+        bucket_from - source bucket name
+        key_from - source key
+        bucket_to - destination bucket name
+        key_to - destination key
+        size (opt) - source object size if known (e.g. from listMatchingS3Keys(returnObj=True)), saves a HEAD for small objects
+        partSize (opt) - bytes per UploadPartCopy part (default = COPY_PART_SIZE)
+        partWorkers (opt) - number of parts copied in parallel, set to 1 to copy parts serially (default = COPY_PART_WORKERS)
+        multipartThreshold (opt) - objects of at least this many bytes use multipart copy, must be <= 5GB (default = COPY_MULTIPART_THRESHOLD)
+    '''
+    copy_source = {'Bucket': bucket_from, 'Key': key_from}
+    head = None
+    if size is None:
+        head = get_s3_client().head_object(**copy_source)
+        size = head['ContentLength']
+    if size < multipartThreshold:
+        get_s3_client().copy_object(CopySource=copy_source, Bucket=bucket_to, Key=key_to)
+        __cache_invalidate(bucket_to, key_to) #after the copy, so a lookup racing it can't re-cache the old state
+        return
+
+    if head is None:
+        head = get_s3_client().head_object(**copy_source)
+    #CopyObject carries content headers over automatically, multipart copies have to set them on the new upload
+    upload_args = {arg: head[arg] for arg in ('ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl', 'Metadata') if head.get(arg)}
+    upload_id = get_s3_client().create_multipart_upload(Bucket=bucket_to, Key=key_to, **upload_args)['UploadId']
+    try:
+        def copy_part(part):
+            part_number, start = part
+            end = min(start + partSize, size) - 1
+            response = get_s3_client().upload_part_copy(
+                Bucket=bucket_to, Key=key_to, UploadId=upload_id, PartNumber=part_number,
+                CopySource=copy_source, CopySourceRange=f'bytes={start}-{end}', CopySourceIfMatch=head['ETag']
+            )
+            return {'PartNumber': part_number, 'ETag': response['CopyPartResult']['ETag']}
+
+        parts = list(enumerate(range(0, size, partSize), start=1))
+        if partWorkers > 1 :
+            with ThreadPool(min(partWorkers, len(parts))) as pool:
+                completed = pool.map(copy_part, parts)
+        else :
+            completed = [copy_part(part) for part in parts]
+        get_s3_client().complete_multipart_upload(Bucket=bucket_to, Key=key_to, UploadId=upload_id, MultipartUpload={'Parts': completed})
+        __cache_invalidate(bucket_to, key_to)
+    except BaseException:
+        get_s3_client().abort_multipart_upload(Bucket=bucket_to, Key=key_to, UploadId=upload_id)
+        raise
+    logger.debug(f'Function copy_s3_object - copied {bucket_from}/{key_from} to {bucket_to}/{key_to} in {len(parts)} parts')
+
+
+def __copy_listed_object(bucket_from:str, key_from:str, bucket_to:str, key_to:str, size:int, deleter:BatchDeleter = None, **copyArgs):
+    '''Fast path used by copyFilesInS3 for keys straight from a listing: copy, then queue the source for deletion'''
+    copy_s3_object(bucket_from, key_from, bucket_to, key_to, size, **copyArgs)
+    if deleter is not None :
+        deleter.add(bucket_from, key_from)
+    logger.info(f'successfully copied s3://{bucket_from}/{key_from} to s3://{bucket_to}/{key_to}')
+
+
+def copyFileInS3(s3urlfrom, s3urlto, delete=False, rename = False, deleter = None) :
     '''
     copyFileInS3 - Copy a single file from one S3 location to another
     s3urlfrom (req) - S3 URL of keys to move
@@ -305,6 +1755,7 @@ def copyFileInS3(s3urlfrom, s3urlto, delete=False, rename = False) :
     archive (opt)
     fdw_callback (opt) - perform a callback using FDW metadata in the s3 key to show file was delivered (as if it had gone through FDW)
     rename (opt) - s3urlto contains full s3 path and filename
+    deleter (opt) - BatchDeleter to queue the source key on when delete is True, instead of deleting it immediately
     '''
 
     bucket_from = return_s3bucket(s3urlfrom)
@@ -326,18 +1777,21 @@ def copyFileInS3(s3urlfrom, s3urlto, delete=False, rename = False) :
 
     logger.debug(f'From -> bucket_from: {bucket_from} | s3folderpath_from: {s3folderpath_from} | filename: {s3filename_from}')
     logger.debug(f'To -> bucket_to: {bucket_to} | s3folderpath_to: {s3folderpath_to} | filename: {s3filename_to}')
-    s3c.copy( { 'Bucket' : bucket_from.name, 'Key': s3folderpath_from + s3filename_from}, bucket_to.name, s3folderpath_to + s3filename_to)
+    copy_s3_object(bucket_from.name, s3folderpath_from + s3filename_from, bucket_to.name, s3folderpath_to + s3filename_to)
     #bucket_to.copy( { 'Bucket' : bucket_from.name, 'Key': s3folderpath_from }, s3folderpath_to + return_s3filename(s3urlfrom))
-    if delete :
+    if delete and deleter is not None :
+        deleter.add(bucket_from.name, s3folderpath_from + s3filename_from)
+    elif delete :
         logger.debug(f'Deleting object {bucket_from.name}/{s3folderpath_from}{s3filename_from}')
-        s3c.delete_object(
+        get_s3_client().delete_object(
             Bucket=bucket_from.name,
             Key=s3folderpath_from + s3filename_from
         )
+        __cache_invalidate(bucket_from.name, s3folderpath_from + s3filename_from)
     logger.info(f'successfully copied {s3urlfrom} to {s3urlto}')
 
 
-def copyFilesInS3(s3urlfrom, s3urlto, suffix='', delete=False, archive=False, poolWorkers = 150, limit = 0):
+def copyFilesInS3(s3urlfrom, s3urlto, suffix='', delete=False, archive=False, poolWorkers = 150, limit = 0, maxPending = None, partSize = COPY_PART_SIZE, partWorkers = COPY_PART_WORKERS, multipartThreshold = COPY_MULTIPART_THRESHOLD, metrics = None, adaptive = False, journal = None):
     '''
     copyFilesInS3 - Copy a set of files from one S3 location to another
     s3urlfrom (req) - S3 URL of keys to move
@@ -347,6 +1801,15 @@ def copyFilesInS3(s3urlfrom, s3urlto, suffix='', delete=False, archive=False, po
     archive (opt) - Default: False - Archive the source file after copying
     poolWorkers (opt) - Default: 100 - Number of threads to use to speed up copying
     limit (opt) - Default: none - Number of files to move before returning
+    maxPending (opt) - Default: 2 * poolWorkers - Maximum copies queued at once before listing pauses
+    partSize (opt) - Default: COPY_PART_SIZE - bytes per UploadPartCopy part for large objects
+    partWorkers (opt) - Default: COPY_PART_WORKERS - parts of each large object copied in parallel
+    multipartThreshold (opt) - Default: COPY_MULTIPART_THRESHOLD - objects of at least this size use multipart copy
+    metrics (opt) - Default: new TransferMetrics - TransferMetrics to report progress on, e.g. TransferMetrics(progressCallback=print)
+    adaptive (opt) - Default: False - True or an AdaptiveConcurrency to start below poolWorkers copies in flight, back off when S3 throttles and retry throttled keys
+    journal (opt) - Default: None - path to a SQLite TransferJournal (see lp_logging) recording copied keys and the listing position, so rerunning an interrupted or failed copy resumes where it stopped
+
+    Returns - TaskResults with any per-key errors, or None if the arguments are invalid
     '''
     logger.debug(f'Function copyFilesInS3 - archive: {archive}|delete: {delete}|poolWorkers: {poolWorkers}|limit: {limit}')
     if delete and archive :
@@ -358,65 +1821,231 @@ def copyFilesInS3(s3urlfrom, s3urlto, suffix='', delete=False, archive=False, po
         logger.error("Function copyFilesInS3 - s3url destination needs to match s3urlfrom or represent a folder '/'")
         return
 
-    if poolWorkers > 1 : #if set to 1, skip multiprocessing
-        pool = ThreadPool(poolWorkers)
-
-    count = 0
+    deleter = BatchDeleter() if delete else None
+    pool = BoundedTaskPool(poolWorkers, maxPending, metrics, __adaptive_concurrency(adaptive, poolWorkers)) #if poolWorkers is 1, copies run serially
+    #Parse the URLs once, every listed key is then copied straight from its (bucket, key, size)
+    bucket_from = return_s3bucket(s3urlfrom).name
+    bucket_to = return_s3bucket(s3urlto).name
+    s3folderpath_to = return_s3folderpath(s3urlto)
+    if s3folderpath_to == '/' : #top level of the bucket
+        s3folderpath_to = ''
+    copyArgs = {'partSize': partSize, 'partWorkers': partWorkers, 'multipartThreshold': multipartThreshold}
+    checkpoint = TransferCheckpoint(journal, f'copyFilesInS3 {s3urlfrom} -> {s3urlto} suffix={suffix}', deleter) if journal else None
+    if checkpoint is not None :
+        listing = __journaled_objects(checkpoint, s3urlfrom, suffix)
+    else :
+        listing = ((obj, False) for obj in listMatchingS3Keys(s3urlfrom, suffix, returnObj = True))
+    listed_all = False
     try :
-        bucket_from = return_s3bucket(s3urlfrom)
-        for key in listMatchingS3Keys(s3urlfrom, suffix) :
-            if poolWorkers > 1 :
-                logger.debug(f'copyFilesInS3 - delivering {key} multi-processed')
-                pool.apply_async(copyFileInS3, (bucket_from.name + '/' + key, s3urlto, delete,),)
-            else :
-                logger.debug(f'copyFilesInS3 - delivering {key} serially')
-                copyFileInS3(bucket_from.name + '/' + key, s3urlto, delete)
-            count += 1
+        for obj, finished in listing :
+            key = obj['Key']
+            if finished : #copied by an earlier run, it may not have lived to delete the source
+                if deleter is not None :
+                    deleter.add(bucket_from, key)
+                continue
+            logger.debug(f'copyFilesInS3 - delivering {key}')
+            task = (checkpoint.run, key, __copy_listed_object) if checkpoint is not None else (__copy_listed_object,)
+            pool.submit(*task, bucket_from, key, bucket_to, s3folderpath_to + key.rsplit('/', 1)[-1], obj['Size'], deleter, taskBytes=obj['Size'], **copyArgs)
             if limit:
-                if count >= limit :
+                if pool.taskresults.submitted >= limit :
                     break
+        else :
+            listed_all = True
     except KeyboardInterrupt :
         # Ctrl-C pressed
         logger.info("Cancelling copy...")
-        if poolWorkers > 1 :
-            pool.close()
-            pool.join()  # Wait for all operations to finish
-    if poolWorkers > 1 :
-        pool.close()
-        pool.join()  # Wait for all operations to finish
-
-
-def write_file_to_S3(s3url, content):
+        pool.cancel()
+    except Exception : #listing failed, don't start the queued copies but finish and delete the ones running
+        pool.cancel()
+        raise
+    finally :
+        results = pool.join()  # Wait for all operations to finish
+        if deleter is not None :
+            __flush_deleter(deleter, results, 'copyFilesInS3')
+    if checkpoint is not None and listed_all and not results.errors and not results.cancelled :
+        checkpoint.finish()
+    if results.errors :
+        logger.error(f'Function copyFilesInS3 - {len(results.errors)} of {results.submitted} copies failed')
+    __log_metrics('copyFilesInS3', results.metrics)
+    return results
+
+
+def write_file_to_S3(s3url, content, compression = None, level = None):
     '''
     Writes a file directly to S3 without needing a file path.
     s3url: an S3 url of the flavor s3://bucket/some/path/to/key.ext
-    content: the content that will be written to the file
+    content: the content that will be written to the file - str, bytes, a readable file object, or an iterable of str/bytes
+            chunks (e.g. a generator) which is streamed to S3 without being held in memory
+    compression (opt): None, 'gzip', 'zstd', or 'auto' to compress keys ending .gz/.zst - the content is compressed in chunks as
+            it is uploaded. Keys without a matching extension get a Content-Encoding so getS3FileContents decompresses them. (default = None)
+    level (opt): compression level (default = the codec's default)
     '''
     bucket = return_s3bucket(s3url)
     key = return_s3path(s3url)
+    codec = __write_codec(key, compression)
     if isinstance(content,str):
         content = bytes(content.encode())
-    s3c.put_object(Body=content,Bucket=bucket.name,Key=key)
+    if codec is None and isinstance(content, (bytes, bytearray)) :
+        get_s3_client().put_object(Body=content,Bucket=bucket.name,Key=key)
+    else :
+        extraArgs = {}
+        if codec is not None and COMPRESSION_EXTENSIONS.get(Path(key).suffix.lower()) != codec :
+            extraArgs['ContentEncoding'] = codec
+        get_s3_client().upload_fileobj(ChunkedReader(__content_chunks(content), codec, level), bucket.name, key, ExtraArgs=extraArgs, Config=upload_transfer_config())
+    __cache_invalidate(bucket.name, key)
 
 def delete_key(bucket, key):
     '''
     TODO - This should be able to use either a Bucket object or a Bucket name (str)
     '''
-    s3c.delete_object(Bucket = bucket,Key = key)
+    get_s3_client().delete_object(Bucket = bucket,Key = key)
+    __cache_invalidate(bucket, key)
+
+def delete_keys(bucket:str, keys) -> list:
+    '''
+    delete_keys - Delete many keys from a bucket using DeleteObjects, DELETE_BATCH_SIZE keys per request
+        bucket - bucket name
+        keys - iterable of keys to delete
+
+    Returns - list of {'Key', 'Code', 'Message'} dicts for keys that could not be deleted (empty when all succeeded)
+    '''
+    errors = []
+    keys = iter(keys)
+    while True:
+        batch = [{'Key': key} for _, key in zip(range(DELETE_BATCH_SIZE), keys)]
+        if not batch:
+            return errors
+        try:
+            response = get_s3_client().delete_objects(Bucket=bucket, Delete={'Objects': batch, 'Quiet': True})
+            errors.extend(response.get('Errors', []))
+            __cache_invalidate(bucket, *(obj['Key'] for obj in batch))
+        except botocore.exceptions.ClientError as e: #the whole request failed, so every key in it failed
+            errors.extend({'Key': obj['Key'], 'Code': e.response['Error']['Code'], 'Message': e.response['Error'].get('Message', '')} for obj in batch)
+        logger.debug(f'Function delete_keys - sent DeleteObjects for {len(batch)} keys in {bucket}')
 
 def object_key_exists(bucket,key):
+    '''
+    object_key_exists - HEAD the key to check it exists. With enable_metadata_cache() on, repeat checks and keys in a
+    cached listing of their folder are answered from memory.
+    '''
+    exists = __cache_get(('head', bucket, key))
+    if exists is not None:
+        return exists
+    folder = key.rsplit('/', 1)[0] + '/' if '/' in key else ''
+    listed = __cache_get(('list', bucket, folder, '/'))
+    if listed is not None:
+        return any(obj['Key'] == key for obj in listed)
     try:
-        s3.Object(bucket,key).load() #grabs S3 object head if it exists as a fast check to see if it exists
+        get_s3_client().head_object(Bucket=bucket, Key=key) #grabs S3 object head if it exists as a fast check to see if it exists
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             #print (f"{bucket} {key} does not exist")
+            __cache_put(('head', bucket, key), False)
             return False
     else:
         #print (f"{bucket} {key} exists")
+        __cache_put(('head', bucket, key), True)
         return True
 
 
-def listMatchingS3Keys(s3url: str, suffix='', returnObj = False, s3delimiter = '/') -> Generator :
+def __head_exists(bucket:str, key:str) -> bool:
+    '''HEAD a key for keys_exist, raising errors other than 404'''
+    try:
+        get_s3_client().head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+def __list_for_keys(bucket:str, keys:list) -> tuple:
+    '''
+    Answer sorted keys sharing a folder with one listing from just before the first key to the last. Returns (found, unresolved),
+    unresolved being the keys past where the listing stopped once it used up its page budget.
+    '''
+    keyset = set(keys)
+    found = set()
+    budget = -(-len(keys) // KEYS_EXIST_KEYS_PER_PAGE)
+    kwargs = {'Bucket': bucket, 'Prefix': os.path.commonprefix(keys), 'StartAfter': keys[0][:-1]}
+    last_key = ''
+    for _ in range(budget) :
+        page = get_s3_client().list_objects_v2(**kwargs)
+        for obj in page.get('Contents', []) :
+            if obj['Key'] in keyset :
+                found.add(obj['Key'])
+            last_key = obj['Key']
+        if not page.get('IsTruncated') or last_key >= keys[-1] :
+            return found, []
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+    return found, [key for key in keys if key > last_key]
+
+
+def keys_exist(bucket:str, keys, poolWorkers:int = 50) -> dict:
+    '''
+    keys_exist - Check which of many keys exist, with far fewer requests than a HEAD per key. Keys are grouped by folder;
+    folders with at least KEYS_EXIST_LIST_MIN requested keys are answered by listing the range the keys span, and the
+    rest (plus any keys a listing gave up on as too expensive) are HEADed in parallel. Results are shared with
+    object_key_exists through the metadata cache when enable_metadata_cache() is on.
+        bucket - bucket name
+        keys - iterable of keys to check
+        poolWorkers (opt) - listings and HEADs run in parallel (default = 50)
+
+    Returns - dict of key: True/False for every requested key. Errors other than a missing key are raised.
+    '''
+    exists = {}
+    pending = []
+    for key in set(keys) :
+        cached = __cache_get(('head', bucket, key))
+        if cached is None :
+            pending.append(key)
+        else :
+            exists[key] = cached
+    pending.sort()
+
+    folders = {}
+    for key in pending :
+        folders.setdefault(key.rsplit('/', 1)[0] + '/' if '/' in key else '', []).append(key)
+    listed = [group for group in folders.values() if len(group) >= KEYS_EXIST_LIST_MIN]
+    head_keys = [key for group in folders.values() if len(group) < KEYS_EXIST_LIST_MIN for key in group]
+
+    with ThreadPool(max(1, min(poolWorkers, len(pending)))) as pool :
+        for group, (found, unresolved) in zip(listed, pool.imap(lambda group: __list_for_keys(bucket, group), listed)) :
+            unresolved_keys = set(unresolved)
+            for key in group :
+                if key not in unresolved_keys :
+                    exists[key] = key in found
+            head_keys.extend(unresolved)
+        for key, found in zip(head_keys, pool.imap(lambda key: __head_exists(bucket, key), head_keys)) :
+            exists[key] = found
+
+    for key in pending :
+        __cache_put(('head', bucket, key), exists[key])
+    logger.debug(f'Function keys_exist - {len(pending)} keys checked with {len(listed)} listings and {len(head_keys)} HEADs')
+    return exists
+
+
+def __list_objects(bucket:str, s3folderpath:str, s3delimiter:str) -> Generator :
+    '''Page through list_objects_v2, caching the complete listing if the metadata cache is on, the listing is read to the end
+    and it holds no more than the cache's maxListingSize objects'''
+    cache = __metadata_cache
+    listed = [] if cache is not None else None
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+
+    kwargs = {'Bucket':bucket, 'Prefix':s3folderpath, 'Delimiter':s3delimiter} #Set Delimiter to prevent sub-directories from being listed as well
+    logger.debug(kwargs)
+    for page in paginator.paginate(**kwargs):
+        contents = page.get("Contents", []) #pages can hold only CommonPrefixes, later pages may still have keys
+        if listed is not None :
+            listed.extend(contents)
+            if len(listed) > cache.maxListingSize : #too big to hold in memory, stream the rest
+                listed = None
+        yield from contents
+    if listed is not None :
+        __cache_put(('list', bucket, s3folderpath, s3delimiter), listed)
+
+
+def listMatchingS3Keys(s3url: str, suffix='', returnObj = False, s3delimiter = '/', maxShards = 1, ordered = True) -> Generator :
     '''
     listMatchingS3Keys - Used to iterate/list a directory of contents in S3, will return either an S3 object or a string. Uses
                     a Boto3 paginator to return results for searches with more than 1,000 keys returned.
@@ -442,29 +2071,227 @@ def listMatchingS3Keys(s3url: str, suffix='', returnObj = False, s3delimiter = '
         this suffix (optional).
     :param returnObj: Return an s3 object instead of a string (optional)
     :param s3delimiter: delimiter used across "folders", at this is '/'
+    :param maxShards: list up to this many shards of the key space in parallel, see listMatchingS3KeysParallel (default 1 = single paginator)
+    :param ordered: with maxShards > 1, return keys in key order rather than as shards complete
+
+    With enable_metadata_cache() on, a complete listing is cached and reused for repeat calls on the same prefix.
     '''
+    if maxShards > 1 :
+        yield from listMatchingS3KeysParallel(s3url, suffix, returnObj, s3delimiter, maxShards, ordered)
+        return
+
     bucket = return_s3bucket(s3url)
     s3folderpath = return_s3path(s3url)
 
-    paginator = s3c.get_paginator("list_objects_v2")
+    listed = __cache_get(('list', bucket.name, s3folderpath, s3delimiter))
+    if listed is None :
+        listed = __list_objects(bucket.name, s3folderpath, s3delimiter)
+    for obj in listed :
+        #Don't return keys that are folders
+        if obj["Key"].endswith('/') :
+            continue
+        if obj["Key"].endswith(suffix):
+            if returnObj :
+                yield obj
+            else :
+                yield obj["Key"]
+
+
+def __next_key(bucket:str, prefix:str, startAfter:str = None) -> str:
+    '''The first key under prefix that sorts after startAfter, or None'''
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': 1}
+    if startAfter :
+        kwargs['StartAfter'] = startAfter
+    contents = get_s3_client().list_objects_v2(**kwargs).get('Contents', [])
+    return contents[0]['Key'] if contents else None
 
-    kwargs = {'Bucket':bucket.name, 'Prefix':s3folderpath, 'Delimiter':s3delimiter} #Set Delimiter to prevent sub-directories from being listed as well
-    logger.debug(kwargs)
-    for page in paginator.paginate(**kwargs):
-        try:
-            contents = page["Contents"]
-        except KeyError:
-            break
 
-        for obj in contents:
-            #Don't return keys that are folders
-            if obj["Key"].endswith('/') :
+def __char_after(char:str) -> str:
+    return chr(min(ord(char) + 1, sys.maxunicode))
+
+
+def __common_key_prefix(bucket:str, prefix:str, startAfter:str = None) -> str:
+    '''The longest prefix the keys under prefix after startAfter share (binary search with one key probes), None if there are none'''
+    first = __next_key(bucket, prefix, startAfter)
+    if first is None :
+        return None
+    shared, longest = len(prefix), len(first)
+    while shared < longest :
+        length = (shared + longest + 1) // 2
+        #first is the smallest key, so all keys share first[:length] unless one sorts after that prefix's range
+        if __next_key(bucket, prefix, first[:length - 1] + __char_after(first[length - 1])) is None :
+            shared = length
+        else :
+            longest = length - 1
+    return first[:shared]
+
+
+def __split_key_range(bucket:str, prefix:str, shards:int, startAfter:str = None) -> list:
+    '''
+    Boundaries splitting the keys under prefix that sort after startAfter into up to shards key ranges. Descends past
+    the prefix all those keys share, probes for the distinct characters that follow it, and either groups the
+    characters into shards ranges or gives each character its share of the shards and splits it the same way, so the
+    ranges follow the keys that exist rather than a fixed alphabet.
+    '''
+    if shards <= 1 :
+        return []
+    prefix = __common_key_prefix(bucket, prefix, startAfter)
+    if prefix is None :
+        return []
+    chars = []
+    key = __next_key(bucket, prefix, max(prefix, startAfter or ''))
+    while key is not None and len(chars) < LIST_SPLIT_MAX_CHARS :
+        chars.append(key[len(prefix)])
+        key = __next_key(bucket, prefix, prefix + __char_after(chars[-1]))
+    if not chars : #prefix is the only key
+        return []
+    if len(chars) >= shards :
+        step = len(chars) / shards
+        return [prefix + chars[int(i * step)] for i in range(1, shards)]
+    if len(chars) == 1 : #only prefix itself sorts before the one character, split inside it
+        return __split_key_range(bucket, prefix + chars[0], shards, startAfter)
+
+    shares = [shards // len(chars) + (i < shards % len(chars)) for i in range(len(chars))]
+    with ThreadPool(len(chars)) as pool:
+        inner = pool.starmap(__split_key_range, [(bucket, prefix + char, share, startAfter) for char, share in zip(chars, shares)])
+    bounds = []
+    for i, char in enumerate(chars):
+        if i :
+            bounds.append(prefix + char)
+        bounds.extend(inner[i])
+    return bounds
+
+
+def __list_units(bucket:str, prefix:str, s3delimiter:str, maxShards:int) -> list:
+    '''
+    Split a listing into independently listable units, in key order. A unit is either a list of already listed
+    objects, or a (prefix, startAfter, upper) shard covering keys under prefix that are > startAfter and <= upper.
+    Recursive listings shard on the CommonPrefixes under prefix when there are at least two, anything else is split
+    into up to maxShards key ranges chosen by __split_key_range. Keys a too flat recursive listing already read while
+    looking for CommonPrefixes are returned as the first unit and the ranges start after them.
+    '''
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    listed = []
+    while s3delimiter == '' :
+        common, direct = [], []
+        for pagecount, page in enumerate(paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')):
+            if pagecount >= LIST_DISCOVERY_PAGES : #too flat to shard by "folder"
+                break
+            common.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+            direct.extend(page.get('Contents', []))
+        else :
+            if len(common) == 1 and not direct : #single "folder", look for shards inside it
+                prefix = common[0]
                 continue
-            if obj["Key"].endswith(suffix):
-                if returnObj :
-                    yield obj
-                else :
-                    yield obj["Key"]
+            if len(common) >= 2 :
+                units = []
+                for _, unit in sorted([(obj['Key'], obj) for obj in direct] + [(p, (p, None, None)) for p in common], key=lambda u: u[0]):
+                    if isinstance(unit, tuple) :
+                        units.append(unit)
+                    elif units and isinstance(units[-1], list) : #group consecutive top level keys into one unit
+                        units[-1].append(unit)
+                    else :
+                        units.append([unit])
+                return units
+            if not common : #every key is at this level and already listed
+                return [direct] if direct else []
+        #keep the keys sorting before the first "folder", the keys under folders were not listed
+        listed = [obj for obj in direct if not common or obj['Key'] < min(common)]
+        break
+
+    last = listed[-1]['Key'] if listed else None
+    bounds = [last] + __split_key_range(bucket, prefix, maxShards, last) + [None]
+    shards = [(prefix, bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+    return [listed] + shards if listed else shards
+
+
+def __list_shard(bucket:str, shard:tuple, s3delimiter:str, suffix:str, returnObj:bool, emit) :
+    '''List one (prefix, startAfter, upper) shard, passing each page of matching keys to emit() until it returns False'''
+    prefix, startAfter, upper = shard
+    kwargs = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': s3delimiter}
+    if startAfter is not None :
+        kwargs['StartAfter'] = startAfter
+    for page in get_s3_client().get_paginator('list_objects_v2').paginate(**kwargs):
+        items = []
+        for obj in page.get('Contents', []):
+            if upper is not None and obj['Key'] > upper : #reached the next shard's range
+                emit(items)
+                return
+            if obj['Key'].endswith('/') or not obj['Key'].endswith(suffix) : #filter before anything is queued
+                continue
+            items.append(obj if returnObj else obj['Key'])
+        if not emit(items) :
+            return
+
+
+def listMatchingS3KeysParallel(s3url: str, suffix='', returnObj = False, s3delimiter = '', maxShards = 16, ordered = False) -> Generator :
+    '''
+    listMatchingS3KeysParallel - listMatchingS3Keys for very large listings. The key space is split into shards (the
+    "folders" under s3url for recursive listings, otherwise lexicographic key ranges) which are listed concurrently and
+    merged into a single generator. Each shard buffers at most LIST_QUEUE_PAGES pages ahead of the reader.
+        s3url - S3 url where you want to return the list
+        suffix (opt) - Only return keys ending with this, applied in the shard threads before keys are queued
+        returnObj (opt) - default = False - return the listed object dict instead of the key name
+        s3delimiter (opt) - default = '' (recursive) - delimiter used when listing each shard
+        maxShards (opt) - default = 16 - maximum number of shards listed at the same time
+        ordered (opt) - default = False - return keys in key order (shards are still prefetched in parallel),
+                    otherwise keys are returned as soon as any shard lists them
+
+    Returns - Default: string of the key name, Optionally: dict of the listed object
+    '''
+    bucket = return_s3bucket(s3url).name
+    units = __list_units(bucket, return_s3path(s3url), s3delimiter, maxShards)
+    if not units :
+        return
+    logger.debug(f'Function listMatchingS3KeysParallel - listing {s3url} as {len(units)} shards')
+
+    stop = threading.Event()
+    queues = [queue.Queue(LIST_QUEUE_PAGES) for _ in units] if ordered else [queue.Queue(LIST_QUEUE_PAGES * maxShards)]
+
+    def work(index, unit):
+        shard_queue = queues[index] if ordered else queues[0]
+
+        def send(item) -> bool:
+            while not stop.is_set() : #give up if the reader has gone away
+                try:
+                    shard_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def emit(items) -> bool:
+            return send(items) if items else not stop.is_set()
+
+        try:
+            if isinstance(unit, list) :
+                emit([obj if returnObj else obj['Key'] for obj in unit if not obj['Key'].endswith('/') and obj['Key'].endswith(suffix)])
+            else :
+                __list_shard(bucket, unit, s3delimiter, suffix, returnObj, emit)
+            send(None) #shard finished
+        except Exception as e:
+            send(e)
+
+    pool = ThreadPool(min(maxShards, len(units)))
+    for index, unit in enumerate(units):
+        pool.apply_async(work, (index, unit))
+    pool.close()
+    try:
+        remaining = len(units)
+        shard_index = 0
+        while remaining :
+            item = queues[shard_index].get() if ordered else queues[0].get()
+            if item is None :
+                remaining -= 1
+                if ordered :
+                    shard_index += 1
+            elif isinstance(item, Exception) :
+                raise item
+            else :
+                yield from item
+    finally:
+        stop.set() #shards still running stop at their next page
+        pool.join()
 
 
 def listDirectories(s3url: str) -> dict:
@@ -480,7 +2307,13 @@ def listDirectories(s3url: str) -> dict:
     if s3folderpath == '' :
         logger.debug('Calling this function at the top level is probably not what you wanted to do, and will take a long time to run for most S3 Buckets')
 
-    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    listed = __cache_get(('dirs', bucket.name, s3folderpath))
+    if listed is not None :
+        yield from listed
+        return
+    listed = []
+
+    paginator = get_s3_client().get_paginator("list_objects_v2")
 
     kwargs = {'Bucket': bucket.name, 'Prefix' : s3folderpath, 'Delimiter' : '/'} #Set Delimiter to prevent sub-directories from being listed as well
     logger.debug(kwargs)
@@ -489,9 +2322,12 @@ def listDirectories(s3url: str) -> dict:
         logger.debug(page)
         if page.get('CommonPrefixes') is None:
             logger.debug('List of directories returned 0 results')
+            __cache_put(('dirs', bucket.name, s3folderpath), listed)
             return '' #return empty instead of None to prevent iterator exceptions with empty lists
         for object in page.get('CommonPrefixes'):
+            listed.append(object)
             yield object
+    __cache_put(('dirs', bucket.name, s3folderpath), listed)
 
 
 def main() :
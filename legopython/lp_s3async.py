@@ -0,0 +1,120 @@
+'''Module to interact with AWS S3 from asyncio applications.
+
+Async counterparts of the main lp_s3 operations. boto3 is blocking, so each S3 request runs on a thread pool owned by
+an AsyncS3 instance and an asyncio.Semaphore caps the requests in flight. Coroutines waiting on the semaphore don't hold
+a thread, so thousands of operations can be scheduled at once while only `concurrency` of them talk to S3.
+
+Examples:
+
+    async with lp_s3async.AsyncS3(concurrency=64) as s3:
+        keys = [key async for key in s3.list_keys('s3://bucket/prefix/')]
+        await asyncio.gather(*(s3.download('bucket', key, '/tmp/' + key.split('/')[-1]) for key in keys))
+'''
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncGenerator
+from legopython import lp_s3
+from legopython.lp_logging import logger
+
+
+class AsyncS3:
+    '''
+    AsyncS3 - asyncio front end for lp_s3, use as an async context manager so its threads are shut down afterwards.
+        concurrency (opt) - maximum number of S3 requests in flight at once (default = 64)
+    '''
+    def __init__(self, concurrency:int = 64):
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix='lp_s3async')
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.aclose()
+
+    def close(self):
+        '''Shut down the thread pool, waiting for running requests to finish'''
+        self._executor.shutdown(wait=True)
+
+    async def aclose(self):
+        '''close() from a coroutine, waiting for running requests on another thread so the event loop keeps running'''
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def _call(self, func, *args, **kwargs):
+        '''Run a blocking lp_s3/boto3 call on the pool once a concurrency slot is free'''
+        if self._semaphore is None: #created lazily so it binds to the running event loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def list_keys(self, s3url:str, suffix:str = '', returnObj:bool = False, s3delimiter:str = '/') -> AsyncGenerator:
+        '''
+        list_keys - async version of lp_s3.listMatchingS3Keys, fetching one page of up to 1,000 keys per request
+            s3url - S3 url where you want to return the list
+            suffix (opt) - Only return keys which end with this
+            returnObj (opt) - default = False - return the listed object dict instead of the key name
+            s3delimiter (opt) - default = '/' - set to '' to list recursively
+        '''
+        bucket = lp_s3.return_s3bucket(s3url).name
+        pages = iter(lp_s3.get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=lp_s3.return_s3path(s3url), Delimiter=s3delimiter))
+        while True:
+            page = await self._call(next, pages, None)
+            if page is None:
+                return
+            for obj in page.get('Contents', []):
+                if obj['Key'].endswith('/') or not obj['Key'].endswith(suffix):
+                    continue
+                yield obj if returnObj else obj['Key']
+
+    async def get_contents(self, s3url:str) -> bytes:
+        '''get_contents - async version of lp_s3.getS3FileContents, returns the object's bytes'''
+        bucket = lp_s3.return_s3bucket(s3url).name
+        key = lp_s3.return_s3path(s3url)
+
+        def get_object():
+            return lp_s3.get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+        return await self._call(get_object)
+
+    async def download(self, bucket:str, key:str, filepath, partSize:int = lp_s3.DOWNLOAD_PART_SIZE, partWorkers:int = 1) -> dict:
+        '''
+        download - async version of lp_s3.download_s3_object, returns the object's ContentLength/LastModified/ETag
+            partWorkers (opt) - threads fetching ranges of one large object, default 1 so only `concurrency` threads are used
+        '''
+        return await self._call(lp_s3.download_s3_object, bucket, key, filepath, partSize, partWorkers)
+
+    async def upload(self, filepath, s3url:str, transferConfig = None) -> int:
+        '''
+        upload - async version of lp_s3.sendAFileToS3, raises if the upload fails
+            filepath - local file to upload
+            s3url - S3 location to upload to (hint: this should end in '/')
+            transferConfig (opt) - lp_s3.upload_transfer_config() to control multipart uploads (default = single threaded parts)
+
+        Returns - number of bytes uploaded
+        '''
+        if transferConfig is None:
+            transferConfig = lp_s3.upload_transfer_config(partWorkers=1)
+        bucket = lp_s3.return_s3bucket(s3url)
+        return await self._call(lp_s3.sendAFileToS3, Path(filepath), s3url, False, bucket, None, transferConfig, True)
+
+    async def copy(self, bucket_from:str, key_from:str, bucket_to:str, key_to:str, size:int = None):
+        '''copy - async version of lp_s3.copy_s3_object, server side copy of one object'''
+        await self._call(lp_s3.copy_s3_object, bucket_from, key_from, bucket_to, key_to, size, partWorkers=1)
+
+    async def delete(self, bucket:str, keys) -> list:
+        '''
+        delete - async version of lp_s3.delete_keys, keys are sent in DeleteObjects batches of lp_s3.DELETE_BATCH_SIZE
+
+        Returns - list of {'Key', 'Code', 'Message'} dicts for keys that could not be deleted
+        '''
+        keys = list(keys)
+        batches = [keys[i:i + lp_s3.DELETE_BATCH_SIZE] for i in range(0, len(keys), lp_s3.DELETE_BATCH_SIZE)]
+        errors = []
+        for batch_errors in await asyncio.gather(*(self._call(lp_s3.delete_keys, bucket, batch) for batch in batches)):
+            errors.extend(batch_errors)
+        if errors:
+            logger.error(f'Function AsyncS3.delete - {len(errors)} of {len(keys)} keys in {bucket} were not deleted')
+        return errors
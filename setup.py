@@ -42,6 +42,7 @@ setuptools.setup(
     author_email='ralbee1@iwu.edu',
     packages = setuptools.find_packages(),
     install_requires = requires,
+    extras_require = {'zstd': ['zstandard']}, #zstd compression in lp_s3.write_file_to_S3/getS3FileContents
     #entry_points = entry_points, #https://packaging.python.org/en/latest/specifications/entry-points/
     scripts = scripts,
     classifiers = [
@@ -0,0 +1,249 @@
+'''Benchmark the lp_s3 transfer paths against a local S3 stand-in, so regressions can be caught without AWS.
+
+Runs listing, many small object put/get/copy, large object upload/download and delete-after-download at each
+poolWorkers value and writes one JSON object per result line, e.g.
+
+    {"benchmark": "get_small", "poolWorkers": 32, "files": 500, "bytes": 2048000, "seconds": 0.91, "MBps": 2.1, ...}
+
+The S3 stand-in is, in order of preference:
+    --endpoint-url - an already running emulator (moto_server, MinIO, LocalStack...)
+    moto[server] - a ThreadedMotoServer started on a free local port
+    moto - in process mock_aws, no HTTP involved so it measures lp_s3 overhead rather than network behaviour
+
+Examples:
+    python utilities/s3_benchmark.py --workers 1 8 32 --output results.jsonl
+    python utilities/s3_benchmark.py --endpoint-url http://localhost:5000 --small-count 2000 --large-mb 256
+'''
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+#The benchmark must never touch real AWS, so fake credentials are set before lp_s3 creates a client
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.pop('AWS_PROFILE', None)
+
+import boto3
+from legopython import lp_s3, lp_settings
+
+BENCHMARK_BUCKET = 'lp-s3-benchmark'
+
+
+@contextlib.contextmanager
+def s3_stand_in(endpointUrl:str = None):
+    '''Point lp_s3 at a local S3 emulator for the duration of the block, yielding a description of the backend'''
+    if endpointUrl:
+        os.environ['AWS_ENDPOINT_URL'] = endpointUrl
+        yield f'endpoint {endpointUrl}'
+        return
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        ThreadedMotoServer = None
+    if ThreadedMotoServer is not None:
+        with socket.socket() as sock: #find a free port for the server
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        os.environ['AWS_ENDPOINT_URL'] = f'http://127.0.0.1:{port}'
+        try:
+            yield f'moto server 127.0.0.1:{port}'
+        finally:
+            server.stop()
+        return
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('s3_benchmark needs --endpoint-url or moto installed (pip install "moto[server]")')
+    with mock_aws():
+        yield 'moto in process'
+
+
+def make_local_files(folder:Path, count:int, size:int) -> Path:
+    '''Create count files of size random bytes in folder'''
+    folder.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        (folder / f'file{i:06d}.bin').write_bytes(os.urandom(size))
+    return folder
+
+
+def seed_objects(prefix:str, count:int, size:int, workers:int = 32):
+    '''Put count objects of size bytes under prefix directly with boto3, independent of the code being measured'''
+    body = os.urandom(size)
+    def put(i):
+        lp_s3.get_s3_client().put_object(Bucket=BENCHMARK_BUCKET, Key=f'{prefix}file{i:06d}.bin', Body=body)
+    with ThreadPool(workers) as pool:
+        pool.map(put, range(count))
+
+
+def empty_prefix(prefix:str):
+    '''Delete everything under prefix so each run starts from the same state'''
+    keys = list(lp_s3.listMatchingS3Keys(f's3://{BENCHMARK_BUCKET}/{prefix}', s3delimiter=''))
+    if keys:
+        lp_s3.delete_keys(BENCHMARK_BUCKET, keys)
+
+
+def record(benchmark:str, poolWorkers:int, metrics:lp_s3.TransferMetrics = None, **extra) -> dict:
+    '''Build one result line from a TransferMetrics summary plus extra fields'''
+    result = {'benchmark': benchmark, 'poolWorkers': poolWorkers}
+    if metrics is not None:
+        summary = metrics.summary()
+        result.update({
+            'files': summary['files_done'],
+            'failed': summary['files_failed'],
+            'bytes': summary['bytes_done'],
+            'seconds': round(summary['seconds'], 4),
+            'MBps': round(summary['MBps'], 3),
+            'files_per_sec': round(summary['files_done'] / max(summary['seconds'], 1e-6), 1),
+            'p50_latency': summary['p50_latency'],
+            'p99_latency': summary['p99_latency'],
+        })
+    result.update(extra)
+    return result
+
+
+def bench_list(poolWorkers:int, count:int) -> dict:
+    '''List the seeded small objects, sequentially for 1 worker or split into poolWorkers parallel shards'''
+    s3url = f's3://{BENCHMARK_BUCKET}/small/'
+    start_time = time.monotonic()
+    if poolWorkers > 1:
+        listed = sum(1 for _ in lp_s3.listMatchingS3KeysParallel(s3url, maxShards=poolWorkers))
+    else:
+        listed = sum(1 for _ in lp_s3.listMatchingS3Keys(s3url))
+    seconds = time.monotonic() - start_time
+    result = record('list', poolWorkers, files=listed, seconds=round(seconds, 4), files_per_sec=round(listed / max(seconds, 1e-6), 1))
+    if listed != count:
+        result['error'] = f'listed {listed} of {count} keys'
+    return result
+
+
+def bench_put_small(poolWorkers:int, localfolder:Path) -> dict:
+    prefix = f'put/{poolWorkers}/'
+    empty_prefix(prefix)
+    metrics = lp_s3.TransferMetrics()
+    lp_s3.sendFilesToS3(str(localfolder), f's3://{BENCHMARK_BUCKET}/{prefix}', poolWorkers=poolWorkers, metrics=metrics)
+    return record('put_small', poolWorkers, metrics)
+
+
+def bench_get_small(poolWorkers:int, workdir:Path) -> dict:
+    downloadfolder = workdir / f'get{poolWorkers}'
+    downloadfolder.mkdir()
+    metrics = lp_s3.TransferMetrics()
+    lp_s3.getS3Files(f's3://{BENCHMARK_BUCKET}/small/', str(downloadfolder), poolWorkers=poolWorkers, metrics=metrics)
+    shutil.rmtree(downloadfolder)
+    return record('get_small', poolWorkers, metrics)
+
+
+def bench_copy_small(poolWorkers:int) -> dict:
+    prefix = f'copy/{poolWorkers}/'
+    empty_prefix(prefix)
+    metrics = lp_s3.TransferMetrics()
+    lp_s3.copyFilesInS3(f's3://{BENCHMARK_BUCKET}/small/', f's3://{BENCHMARK_BUCKET}/{prefix}', poolWorkers=poolWorkers, metrics=metrics)
+    return record('copy_small', poolWorkers, metrics)
+
+
+def bench_large(poolWorkers:int, largefolder:Path, workdir:Path, partSize:int) -> list:
+    '''Upload and download one large object, poolWorkers being the parts transferred in parallel'''
+    prefix = f'large/{poolWorkers}/'
+    empty_prefix(prefix)
+    upload_metrics = lp_s3.TransferMetrics()
+    lp_s3.sendFilesToS3(str(largefolder), f's3://{BENCHMARK_BUCKET}/{prefix}', poolWorkers=1, partSize=partSize, partWorkers=poolWorkers, multipartThreshold=partSize, metrics=upload_metrics)
+    downloadfolder = workdir / f'large{poolWorkers}'
+    downloadfolder.mkdir()
+    download_metrics = lp_s3.TransferMetrics()
+    lp_s3.getS3Files(f's3://{BENCHMARK_BUCKET}/{prefix}', str(downloadfolder), poolWorkers=1, partSize=partSize, partWorkers=poolWorkers, metrics=download_metrics)
+    shutil.rmtree(downloadfolder)
+    return [record('put_large', poolWorkers, upload_metrics, partSize=partSize), record('get_large', poolWorkers, download_metrics, partSize=partSize)]
+
+
+def bench_delete_after_get(poolWorkers:int, count:int, size:int, workdir:Path) -> dict:
+    '''Download and delete freshly seeded objects, exercising the batched deletes after transfer'''
+    prefix = f'delete/{poolWorkers}/'
+    seed_objects(prefix, count, size)
+    downloadfolder = workdir / f'delete{poolWorkers}'
+    downloadfolder.mkdir()
+    metrics = lp_s3.TransferMetrics()
+    lp_s3.getS3Files(f's3://{BENCHMARK_BUCKET}/{prefix}', str(downloadfolder), delete=True, poolWorkers=poolWorkers, metrics=metrics)
+    shutil.rmtree(downloadfolder)
+    remaining = sum(1 for _ in lp_s3.listMatchingS3Keys(f's3://{BENCHMARK_BUCKET}/{prefix}'))
+    result = record('delete_after_get', poolWorkers, metrics, remaining=remaining)
+    if remaining:
+        result['error'] = f'{remaining} objects were not deleted'
+    return result
+
+
+def run(args) -> list:
+    '''Run every benchmark at each poolWorkers value, writing results to args.output as they complete'''
+    output = open(args.output, 'w') if args.output else sys.stdout
+    results = []
+    def emit(result):
+        results.append(result)
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+    with s3_stand_in(args.endpoint_url) as backend, tempfile.TemporaryDirectory() as tmp:
+        emit({'benchmark': 'environment', 'backend': backend, 'python': platform.python_version(), 'boto3': boto3.__version__,
+              'platform': platform.platform(), 'small_count': args.small_count, 'small_size': args.small_size, 'large_mb': args.large_mb})
+        workdir = Path(tmp)
+        bucketArgs = {} if lp_settings.AWS_REGION == 'us-east-1' else {'CreateBucketConfiguration': {'LocationConstraint': lp_settings.AWS_REGION}} #us-east-1 rejects its own name
+        lp_s3.get_s3_client().create_bucket(Bucket=BENCHMARK_BUCKET, **bucketArgs)
+        seed_objects('small/', args.small_count, args.small_size)
+        smallfolder = make_local_files(workdir / 'small', args.small_count, args.small_size)
+        largefolder = make_local_files(workdir / 'large', 1, args.large_mb * 1048576)
+        partSize = args.part_mb * 1048576
+
+        benchmarks = {
+            'list': lambda workers: bench_list(workers, args.small_count),
+            'put_small': lambda workers: bench_put_small(workers, smallfolder),
+            'get_small': lambda workers: bench_get_small(workers, workdir),
+            'copy_small': bench_copy_small,
+            'large': lambda workers: bench_large(workers, largefolder, workdir, partSize),
+            'delete_after_get': lambda workers: bench_delete_after_get(workers, args.small_count, args.small_size, workdir),
+        }
+        for name in args.benchmarks:
+            for workers in args.workers:
+                try:
+                    outcome = benchmarks[name](workers)
+                except Exception as e: #keep going so one broken path doesn't hide the other numbers
+                    outcome = record(name, workers, error=f'{type(e).__name__}: {e}')
+                for result in outcome if isinstance(outcome, list) else [outcome]:
+                    emit(result)
+    if output is not sys.stdout:
+        output.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lp_s3 against a local S3 stand-in, writing JSON lines of results')
+    parser.add_argument('--endpoint-url', help='S3 emulator to use instead of starting moto')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32], help='poolWorkers values to run each benchmark with')
+    parser.add_argument('--benchmarks', nargs='+', default=['list', 'put_small', 'get_small', 'copy_small', 'large', 'delete_after_get'],
+                        choices=['list', 'put_small', 'get_small', 'copy_small', 'large', 'delete_after_get'])
+    parser.add_argument('--small-count', type=int, default=500, help='number of small objects')
+    parser.add_argument('--small-size', type=int, default=4096, help='bytes per small object')
+    parser.add_argument('--large-mb', type=int, default=64, help='size of the large object in MB')
+    parser.add_argument('--part-mb', type=int, default=8, help='part size for the large object transfers in MB')
+    parser.add_argument('--output', help='file to write JSON lines to (default = stdout)')
+    args = parser.parse_args()
+
+    for handler in logging.getLogger('legopython').handlers : #keep stdout for the JSON results
+        if isinstance(handler, logging.StreamHandler) :
+            handler.setStream(sys.stderr)
+    results = run(args)
+    failures = [result for result in results if result.get('error') or result.get('failed')]
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()